@@ -29,15 +29,28 @@ PROT_SHAPES = {'PSII': PSII_PARTICLE, 'b6f': B6F_PARTICLE, 'UK': UK_PARTICLE} #
 
 ## Efficiency details
 N_PR_NORMALVOTING = 4 # number of processes used for normal voting
+N_PR_SIDE_SEGMENTATION = 1 # number of processes used for finding the picked membrane side (slices are processed in parallel)
+N_PR_SAMPLING = 1 # number of processes used for sampling points (membranes are processed in parallel)
+STORE_SIDE_SEGMENTATIONS = True # if False, the segmentations of the picked sides are not stored (they are only needed for step1b)
+LOW_MEMORY_SAMPLING = False # if True, distance transforms for point sampling are computed in chunks around the membrane (slower, but needs much less memory)
+N_PR_FFT = 1 # number of threads used for the FFTs of low-pass filtering (only used if LP_CUTOFF is not None)
 N_PR_ROTATION = 1 # number of processes used for rotating subvolumes; only recommended for small subvolumes and many sampled points --> mostly 1 is enough!
+SUBVOLUME_COMPRESSION = None # compression of stored subvolumes: None, 'gzip', 'lzf' or 'lz4' (needs hdf5plugin)
+SUBVOLUME_STORAGE_DTYPE = None # dtype of stored subvolumes: None (float32), 'float16', or 'uint8' / 'uint16' (quantized
+                               # with a per-subvolume scale and offset). Smaller dtypes reduce file sizes and training memory.
 
 ## Preprocessing details
 USE_ROTATION_NORMALIZATION = False
+TOMO_SPLINE_COEFFICIENTS = False # only for rotation normalization: if True, spline coefficients are computed once per
+                                 # tomogram instead of for each subvolume (faster, but needs memory of another tomogram)
 ROTATION_AUGMENTATION_DURING_TRAINING = True
 BOX_RANGE = 6 # size of subvolumes sampled (cobe of length BOX_RANGE*2)
 LP_CUTOFF = None    # cutoff value for low-pass filtering of tomogram before extracting subvolumes
                     # (can increase generalizability, but takes some time)
                     # If LP_CUTOFF = None, no low-pass filtering is performed. Otherwise should be in the range 0.0 - 0.25
+CACHE_PREPROCESSED_TOMOS = False # if True, preprocessed tomograms are stored in temp_files/preprocessed_tomos and reused
+                                 # when step 2 is run again with the same tomograms and preprocessing settings
+                                 # (needs disk space for a float32 copy of each tomogram)
 
 
 ## Training settings
@@ -89,3 +102,7 @@ RECLUSTER_BANDWIDTHS = [13, 18, 24]  # Bandwidths for reclustering. Needs to be
 ## Expert settings
 MAX_DIST_FROM_MEMBRANE = 15     # maximum distance for points sampled from membrane segmentation. Higher value increases
                                 # robustness of normals, but increases computing efforts.
+USE_3D_SIDE_SEGMENTATION = False    # If True, the picked membrane side is separated in 3D in a single pass instead of
+                                    # slice-wise. Faster and more robust for strongly tilted membranes.
+POINT_SPACING = 1.5     # minimum distance (in voxels) between points sampled on the membrane. Higher values give fewer
+                        # points and speed up all downstream steps, but reduce the density of the heatmaps.
@@ -8,10 +8,12 @@ from utils import star_utils, data_utils, process_meshes
 from numpy.linalg import inv
 
 
-def load_hdf5_files(settings, split=None):
+def load_hdf5_files(settings, split=None, dequantize=True):
     """
     Load a .h5 file containing positions and subvolumes into a Python dictionary
     @param settings: Parameter settings given y star files
+    @param dequantize: if False, subvolumes are kept in their (compact) storage dtype, and their per-subvolume scales and
+    offsets are added to the dictionary as 'subvolume_scales' and 'subvolume_offsets'
     @return: data dictionary
     """
     assert isinstance(settings, ParameterSettings)
@@ -35,7 +37,10 @@ def load_hdf5_files(settings, split=None):
                 assert tomo_token == tomo_token_temp and mb_token_temp == mb_token
 
                 positions = np.array(sub_file.get(consider_bin).get(combo_token).get('positions'))
-                subvolumes = np.array(sub_file.get(consider_bin).get(combo_token).get('subvolumes'))
+                subvolumes = data_utils.read_subvolumes(sub_file.get(consider_bin).get(combo_token),
+                                                        dequantize=dequantize)
+                if not dequantize:
+                    subvolumes, subvolume_scales, subvolume_offsets = subvolumes
                 normals = np.array(sub_file.get(consider_bin).get(combo_token).get('normals'))
                 angles = np.array(sub_file.get(consider_bin).get(combo_token).get('angles'))
                 data_dict[tomo_token][consider_bin][(stack_token, mb_token)] = {
@@ -44,13 +49,16 @@ def load_hdf5_files(settings, split=None):
                     'normals': normals,
                     'angles': angles
                 }
+                if not dequantize:
+                    data_dict[tomo_token][consider_bin][(stack_token, mb_token)]['subvolume_scales'] = subvolume_scales
+                    data_dict[tomo_token][consider_bin][(stack_token, mb_token)]['subvolume_offsets'] = subvolume_offsets
                 for dist_key in sub_file.get(consider_bin).get(combo_token).keys():
                     if dist_key.startswith('dist_'):
                         data_dict[tomo_token][consider_bin][(stack_token, mb_token)][dist_key] = \
                             np.array(sub_file.get(consider_bin).get(combo_token).get(dist_key))
     return data_dict
 
-def store_dict_in_hdf5(data_dict, settings):
+def store_dict_in_hdf5(data_dict, settings, compression=None):
     subvolume_paths = settings.sub_volume_paths
     for tomo_token in data_dict.keys():
         tomo_path = subvolume_paths[tomo_token]
@@ -64,7 +72,12 @@ def store_dict_in_hdf5(data_dict, settings):
                     mb_group.create_dataset('mb_token', shape=(1,), data=mb_token)
                     mb_group.create_dataset('stack_token', shape=(1,), data=stack_token)
                     mb_group.create_dataset('bin', shape=(1,), data=bin_token[-1])
-                    mb_group.create_dataset('subvolumes', data=data_dict[tomo_token][bin_token][(stack_token, mb_token)]['subvolumes'])
+                    subvolumes = data_dict[tomo_token][bin_token][(stack_token, mb_token)]['subvolumes']
+                    mb_group.create_dataset('subvolumes', data=subvolumes,
+                                            **data_utils.get_h5_compression_kwargs(compression))
+                    if 'subvolume_scales' in cur_keys and subvolumes.dtype.kind != 'f':
+                        mb_group.create_dataset('subvolume_scales', data=data_dict[tomo_token][bin_token][(stack_token, mb_token)]['subvolume_scales'])
+                        mb_group.create_dataset('subvolume_offsets', data=data_dict[tomo_token][bin_token][(stack_token, mb_token)]['subvolume_offsets'])
                     mb_group.create_dataset('positions', data=data_dict[tomo_token][bin_token][(stack_token, mb_token)]['positions'])
                     if 'normals' in cur_keys and data_dict[tomo_token][bin_token][(stack_token, mb_token)]['normals'] \
                             is not None:
@@ -321,7 +334,7 @@ def mahalanobis_for_matrix_to_point(X, point, inv_cov):
     return maha
 
 
-def compute_distances_to_gt(star_file, particle_orientations=False, prot_shapes=None):
+def compute_distances_to_gt(star_file, particle_orientations=False, prot_shapes=None, compression=None):
     if prot_shapes is not None:
         shape_dict = initialize_global_shapes(prot_shapes)
     settings = ParameterSettings(star_file)
@@ -332,7 +345,8 @@ def compute_distances_to_gt(star_file, particle_orientations=False, prot_shapes=
     tomo_tokens = settings.tomo_tokens
     mb_tokens = settings.mb_tokens
     stack_tokens = settings.stack_tokens
-    data_dict = load_hdf5_files(settings)
+    # subvolumes are only copied, so they are kept in their storage dtype
+    data_dict = load_hdf5_files(settings, dequantize=False)
     for tomo_token in tomo_tokens:
         cur_data_dict = data_dict[tomo_token]['bin' + str(settings.consider_bin)]
         for subvol_path, stack_token, mb_token in zip(subvol_paths[tomo_token], stack_tokens[tomo_token],
@@ -364,7 +378,7 @@ def compute_distances_to_gt(star_file, particle_orientations=False, prot_shapes=
                 cur_gt_dists = all_dists.T[mask].T
                 cur_min_dists = np.min(cur_gt_dists, axis=1)
                 cur_data_dict[(stack_token, mb_token)]['distances'][unique_gt_type] = cur_min_dists
-    store_dict_in_hdf5(data_dict, settings)
+    store_dict_in_hdf5(data_dict, settings, compression=compression)
             # dists = np.min(all_dists, axis=1)
             # test_array = np.concatenate((cur_data_points, np.expand_dims(dists, 1)),1)
             # data_utils.store_array_in_csv('/Users/lorenz.lamm/PhD_projects/MemBrain_stuff/test_pipeline/trythis/'
@@ -372,7 +386,7 @@ def compute_distances_to_gt(star_file, particle_orientations=False, prot_shapes=
 
 
 def add_labels_and_distances(star_file, project_directory, membranorama_xmls=False, prot_tokens=None, prot_shapes=None,
-                            particle_orientations=False):
+                            particle_orientations=False, compression=None):
     settings = ParameterSettings(star_file)
     star_dict = star_utils.read_star_file_as_dict(star_file)
     seg_paths = star_dict['segPath']
@@ -382,4 +396,4 @@ def add_labels_and_distances(star_file, project_directory, membranorama_xmls=Fal
     if membranorama_xmls:
         convert_membranorama_gt_to_csv(project_directory, prot_tokens, settings,
                                        convert_orientation=particle_orientations)
-    compute_distances_to_gt(star_file, particle_orientations, prot_shapes)
\ No newline at end of file
+    compute_distances_to_gt(star_file, particle_orientations, prot_shapes, compression=compression)
\ No newline at end of file
@@ -21,6 +21,10 @@ class MeanShift_clustering(object):
         check_mkdir(out_dir)
         self.out_dir = out_dir
         self.detection_by_classification = detection_by_classification
+        # normal voting index of the most recently clustered membrane; only one index is kept, so memory does not grow
+        # with the number of membranes
+        self.nv_index = None
+        self.nv_index_csv = None
         self.__initialize_metrics()
 
     def __initialize_metrics(self):
@@ -216,8 +220,14 @@ class MeanShift_clustering(object):
                                                                                    threshold=3)
         points_with_labels_path = store_points_with_labels(score_file, self.out_dir, all_coords_masked, cluster_labels,
                                                            bandwidth, out_stem='meanshift')
+        if self.nv_index_csv != particle_csv:
+            self.nv_index = None  # release the previous index before building the next one
+            self.nv_index = get_normal_voting_index(particle_csv, self.settings)
+            self.nv_index_csv = particle_csv
         cluster_centers_with_normals = compute_normals_and_angles_for_centers(cluster_centers, particle_csv,
-                                                                              self.settings)
+                                                                              self.settings,
+                                                                              nv_index=self.nv_index,
+                                                                              npr=N_PR_NORMALVOTING)
         if cluster_centers_with_normals.shape[0] == 0:
             cluster_centers_with_normals = np.ones((0, 10))
         out_path = store_cluster_centers(score_file, self.out_dir, cluster_centers_with_normals, bandwidth=bandwidth,
@@ -313,13 +323,22 @@ def store_points_with_labels(score_file, out_dir, coords, labels, bandwidth, out
     return out_path
 
 
-def compute_normals_and_angles_for_centers(cluster_centers, particle_csv, settings):
-    '''Cluster centers should be given in bin1, i.e. also heatmaps should be computed in bin1!'''
+def get_normal_voting_index(particle_csv, settings):
+    '''Indexes the sampled membrane points (scaled to bin1) for voting normals at cluster centers.'''
     scale = settings.consider_bin * 1.0 / 2
     all_array = data_utils.get_csv_data(particle_csv)
     pos_array = np.array(all_array[:, :3], dtype=np.float) * scale
+    # normals are not rescaled: their lengths are compared to len_thres in the sampling binning
     normal_array = np.array(all_array[:, 3:6], dtype=np.float)
-    new_normals = normal_voting.normal_voting_for_pos_and_normal_array(cluster_centers[:, :3], normal_array, neighbor_threshold=50, decay_param=100, len_thres=4, compare_array=pos_array * 2)
+    return normal_voting.NormalVotingIndex(pos_array * 2, normal_array)
+
+
+def compute_normals_and_angles_for_centers(cluster_centers, particle_csv, settings, nv_index=None, npr=1):
+    '''Cluster centers should be given in bin1, i.e. also heatmaps should be computed in bin1!
+    nv_index: NormalVotingIndex of the membrane points; built from particle_csv if not given'''
+    if nv_index is None:
+        nv_index = get_normal_voting_index(particle_csv, settings)
+    new_normals = nv_index.vote(cluster_centers[:, :3], neighbor_threshold=50, decay_param=100, len_thres=4, npr=npr)
     euler_angles = np.array(rotator.compute_Euler_angle_for_single_normals_array(new_normals))
     out_array = np.concatenate((cluster_centers[:, :3], new_normals, euler_angles, np.expand_dims(cluster_centers[:, 3], 1)), axis=1)
     return out_array
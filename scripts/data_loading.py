@@ -5,6 +5,7 @@ import numpy as np
 from utils.parameters import ParameterSettings
 from typing import Optional
 from scripts.add_labels_and_distances import load_hdf5_files
+from utils.data_utils import dequantize_subvolumes
 from config import *
 import scripts.rotator as rotator
 
@@ -115,7 +116,7 @@ class MemBrain_dataset(Dataset):
         self.__get_subvol_paths__()
         self.__load_h5_data()
         if self.subvolumes is not None and normalize:
-            self.subvolumes = self.__scale_subvolumes()
+            self.__scale_subvolumes()
         self.__print__()
         if max_dist is not None:
             self.__cap_distances__(max_dist)
@@ -155,8 +156,11 @@ class MemBrain_dataset(Dataset):
                 del self.settings.sub_volume_paths[tomo_token]
 
     def __load_h5_data(self):
-        data_dict = load_hdf5_files(self.settings, self.split)
+        # subvolumes are kept in their (compact) storage dtype and dequantized in __getitem__
+        data_dict = load_hdf5_files(self.settings, self.split, dequantize=False)
         self.subvolumes = None
+        self.subvolume_scales = None
+        self.subvolume_offsets = None
         self.positions = None
         self.labels = None
         self.normals = None
@@ -171,6 +175,8 @@ class MemBrain_dataset(Dataset):
                     cur_data = data_dict[tomo_token][bin_token][(stack_token, mb_token)]
                     if self.subvolumes is None:
                         self.subvolumes = cur_data['subvolumes']
+                        self.subvolume_scales = cur_data['subvolume_scales']
+                        self.subvolume_offsets = cur_data['subvolume_offsets']
                         self.positions = cur_data['positions']
                         self.normals = cur_data['normals']
                         self.angles = cur_data['angles']
@@ -180,6 +186,8 @@ class MemBrain_dataset(Dataset):
                         self.stack_tokens = [stack_token] * cur_data['subvolumes'].shape[0]
                     else:
                         self.subvolumes = np.concatenate((self.subvolumes, cur_data['subvolumes']))
+                        self.subvolume_scales = np.concatenate((self.subvolume_scales, cur_data['subvolume_scales']))
+                        self.subvolume_offsets = np.concatenate((self.subvolume_offsets, cur_data['subvolume_offsets']))
                         self.positions = np.concatenate((self.positions, cur_data['positions']))
                         self.normals = np.concatenate((self.normals, cur_data['normals']))
                         self.angles = np.concatenate((self.angles, cur_data['angles']))
@@ -209,10 +217,14 @@ class MemBrain_dataset(Dataset):
 
 
     def __scale_subvolumes(self):
-        min = np.amin(self.subvolumes, axis=(1,2,3))
-        max = np.amax(self.subvolumes, axis=(1,2,3))
-        self.subvolumes -= np.expand_dims(min, (1,2,3))
-        self.subvolumes /= (np.expand_dims(max - min, (1,2,3)))
+        # min-max normalization of each subvolume, folded into its scale and offset, so that the (compact) subvolumes
+        # do not need to be converted to float here; they are normalized when dequantized in __getitem__
+        min = np.amin(self.subvolumes, axis=(1,2,3)) * self.subvolume_scales + self.subvolume_offsets
+        max = np.amax(self.subvolumes, axis=(1,2,3)) * self.subvolume_scales + self.subvolume_offsets
+        value_range = max - min
+        value_range[value_range == 0] = 1.
+        self.subvolume_offsets = ((self.subvolume_offsets - min) / value_range).astype(np.float32)
+        self.subvolume_scales = (self.subvolume_scales / value_range).astype(np.float32)
 
     def __scale_single_subvolume(self, subvol):
         min = np.min(subvol)
@@ -247,7 +259,7 @@ class MemBrain_dataset(Dataset):
 
 
     def __getitem__(self, idx):
-        subvol = self.subvolumes[idx]
+        subvol = dequantize_subvolumes(self.subvolumes[idx], self.subvolume_scales[idx], self.subvolume_offsets[idx])
         label = self.labels[idx]
         if not USE_ROTATION_NORMALIZATION:
             if self.use_rotation_augmentation:
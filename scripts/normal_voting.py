@@ -4,8 +4,9 @@ from utils import data_utils
 import utils.star_utils
 import os
 import time
-from sklearn.metrics.pairwise import euclidean_distances
+from scipy.spatial import cKDTree
 import multiprocessing as mp
+from multiprocessing import shared_memory
 
 
 def __load_csv_for_normal_voting(in_path, delimiter=','):
@@ -50,78 +51,89 @@ def __get_distances(pos_array, single_pos):
     return distances
 
 
-def __compute_normal_contribution_single_pos(point, normal, distance, single_pos):
-    conn_vec = point - single_pos
-    if np.linalg.norm(conn_vec) != 0:
-        cosTheta = (-1) * np.dot(normal, conn_vec) / (distance + 1e-5)
-        contribution = normal + 2 * cosTheta * conn_vec / np.linalg.norm(conn_vec)
-    else:
-        contribution = normal
-    return contribution
-
-
-def __compute_normal_contributions(neighbor_points, neighbor_normals, neighbor_distances, single_pos):
-    contributions = np.zeros((0, 3))
-    for i in range(neighbor_points.shape[0]):
-        temp_cont = __compute_normal_contribution_single_pos(neighbor_points[i], neighbor_normals[i],
-                                                           neighbor_distances[i], single_pos)
-        contributions = np.concatenate((contributions, np.expand_dims(temp_cont, 0)), 0)
+def __compute_normal_contributions(conn_vecs, neighbor_normals, neighbor_distances):
+    conn_lengths = np.linalg.norm(conn_vecs, axis=1)
+    nonzero_mask = conn_lengths != 0
+    cos_thetas = (-1) * np.einsum('ij,ij->i', neighbor_normals, conn_vecs) / (neighbor_distances + 1e-5)
+    contributions = neighbor_normals.copy()
+    contributions[nonzero_mask] += 2 * (cos_thetas[nonzero_mask] / conn_lengths[nonzero_mask])[:, np.newaxis] * \
+                                   conn_vecs[nonzero_mask]
     return contributions
 
 
-def __compute_covariance_matrix(contributions, weights):
-    matrix = np.zeros((3, 3))
-    for i in range(contributions.shape[0]):
-        cont = contributions[i]
-        wgt = weights[i]
-        matrix += wgt * np.outer(cont, cont)
-    return matrix
-
-
-def __compute_weights(normals, distances, decay_param, len_thres):
+def __compute_weights(normals, distances, decay_param, len_thres, segment_ids, n_segments):
     normal_lengths = np.linalg.norm(normals, axis=1)
     weights = np.exp((-1) *distances / decay_param)
     thres_mask = normal_lengths < len_thres
-    if np.sum(thres_mask) != normal_lengths.shape[0]:
-        normal_lengths[normal_lengths < len_thres] = 0
+    # short normals are ignored, unless all neighbors of a point have short normals
+    all_short = np.bincount(segment_ids, weights=thres_mask, minlength=n_segments) == \
+                np.bincount(segment_ids, minlength=n_segments)
+    normal_lengths[np.logical_and(thres_mask, np.logical_not(all_short[segment_ids]))] = 0
     weights = weights * normal_lengths
     return weights
 
 
-def __compute_normal_vote(covariance_matrix, single_normal):
-    eigen_values, eigen_vectors = np.linalg.eig(covariance_matrix)
-    max_idx = np.argmax(eigen_values)
-    normal_vote = eigen_vectors[:, max_idx]
-    if np.dot(normal_vote, single_normal) < 0: #np.cos(-1 * np.dot(normal_vote, single_normal)):
-        normal_vote = normal_vote * (-1)
-    return normal_vote
+def __compute_covariance_matrices(contributions, weights, segment_ids, n_segments):
+    outer_products = np.einsum('n,ni,nj->nij', weights, contributions, contributions)
+    matrices = np.zeros((n_segments, 3, 3))
+    for i in range(3):
+        for j in range(3):
+            matrices[:, i, j] = np.bincount(segment_ids, weights=outer_products[:, i, j], minlength=n_segments)
+    return matrices
+
 
+def __compute_normal_votes(covariance_matrices, single_normals):
+    eigen_values, eigen_vectors = np.linalg.eigh(covariance_matrices)
+    max_idcs = np.argmax(eigen_values, axis=1)
+    normal_votes = eigen_vectors[np.arange(eigen_vectors.shape[0]), :, max_idcs]
+    flip_mask = np.einsum('ij,ij->i', normal_votes, single_normals) < 0
+    normal_votes[flip_mask] *= -1
+    return normal_votes
 
-def __normal_voting_for_single_position(pos_array, single_pos, normal_array, single_normal, distances, neighbor_threshold,
-                                      decay_param, len_thres):
+
+def _normal_voting_for_positions(pos_array, query_positions, normal_array, query_normals, neighbor_idcs,
+                                  neighbor_counts, neighbor_threshold, decay_param, len_thres):
+    """
+    Batched normal voting for several query positions at once. The neighbors of all query positions are given as one
+    flat index array (neighbor_idcs into pos_array / normal_array), with neighbor_counts neighbors per query position.
+    """
+    n_queries = query_positions.shape[0]
+    segment_ids = np.repeat(np.arange(n_queries), neighbor_counts)
+    conn_vecs = pos_array[neighbor_idcs] - query_positions[segment_ids]
+    distances = np.linalg.norm(conn_vecs, axis=1)
     neighbor_mask = distances < neighbor_threshold
-    neighbor_distances = distances[neighbor_mask]
-    neighbor_points = pos_array[neighbor_mask]
-    neighbor_normals = normal_array[neighbor_mask]
-    norm = np.transpose(np.tile(np.linalg.norm(neighbor_normals, axis=1), (3, 1)))
+    segment_ids = segment_ids[neighbor_mask]
+    conn_vecs = conn_vecs[neighbor_mask]
+    distances = distances[neighbor_mask]
+    neighbor_normals = normal_array[neighbor_idcs[neighbor_mask]]
+
+    norm = np.linalg.norm(neighbor_normals, axis=1)[:, np.newaxis]
     neighbor_normals_normed = neighbor_normals / norm
-    contributions = __compute_normal_contributions(neighbor_points, neighbor_normals_normed, neighbor_distances, single_pos)
-    weights = __compute_weights(neighbor_normals, neighbor_distances, decay_param, len_thres)
-    cov_matrix = __compute_covariance_matrix(contributions, weights)
-    normal_vote = __compute_normal_vote(cov_matrix, single_normal)
-    return normal_vote
+    contributions = __compute_normal_contributions(conn_vecs, neighbor_normals_normed, distances)
+    weights = __compute_weights(neighbor_normals, distances, decay_param, len_thres, segment_ids, n_queries)
+    cov_matrices = __compute_covariance_matrices(contributions, weights, segment_ids, n_queries)
+    normal_votes = __compute_normal_votes(cov_matrices, query_normals)
+    return normal_votes
 
 
-def _get_mp_split(pos_array_shape, npr):
-    if npr == 1:
-        return np.zeros(pos_array_shape[0])
-    else:
-        out_mask = np.zeros(pos_array_shape[0])
-        step = int(pos_array_shape[0] / npr)
-        for i in range(npr - 1):
-            out_mask[i*step:(i+1)*step] = i
-        out_mask[(i+1) * step:] = npr - 1
-        return out_mask
+def _get_neighbor_chunks(tree, query_array, neighbor_threshold, chunk_size=256):
+    """
+    Generator yielding chunks (start, end, neighbor_idcs, neighbor_counts) of the points of query_array, where
+    neighbor_idcs contains the indices of all points within neighbor_threshold (w.r.t. the points the tree was built
+    on) for the points query_array[start:end], and neighbor_counts the number of neighbors of each of these points.
+    Neighbors are queried chunk-wise from a KD-tree, so memory scales with the number of neighbors instead of
+    requiring a full distance matrix.
+    """
+    for start in range(0, query_array.shape[0], chunk_size):
+        end = min(start + chunk_size, query_array.shape[0])
+        neighbor_lists = tree.query_ball_point(query_array[start:end], r=neighbor_threshold)
+        neighbor_counts = np.array([len(neighbors) for neighbors in neighbor_lists], dtype=np.int64)
+        neighbor_idcs = np.zeros(np.sum(neighbor_counts), dtype=np.int64)
+        offset = 0
+        for neighbors in neighbor_lists:
+            neighbor_idcs[offset:offset + len(neighbors)] = np.sort(neighbors)
+            offset += len(neighbors)
+        yield start, end, neighbor_idcs, neighbor_counts
 
 
 def normal_voting_for_file(in_path, out_path, in_del=',', out_del=',', neighbor_threshold=20, decay_param=100,
@@ -137,70 +149,125 @@ def normal_voting_for_file(in_path, out_path, in_del=',', out_del=',', neighbor_
     print('Total amount of time for this single membrane: ', time.time() - abs_zero)
 
 
-def normal_voting_process(pos_array, normal_array, process_mask, p_nr, return_dict, dist_matrix, compare_array, neighbor_threshold, decay_param, len_thres):
-    new_normals = np.zeros((np.sum(process_mask == p_nr), 4))
-    cur_entry = 0
-    print('Process', p_nr, ':  Processing', np.sum(process_mask == p_nr), 'positions')
-    for i in range(pos_array.shape[0]):
-        if process_mask[i] != p_nr:
-            continue
+_normal_voting_shared = {}
 
-        temp_pos = pos_array[i]
-        temp_normal = normal_array[i]
-        distances = dist_matrix[i]
-        normal_vote = __normal_voting_for_single_position(pos_array, temp_pos, normal_array, temp_normal, distances,
-                                                          neighbor_threshold,
-                                                          decay_param, len_thres)
-        new_normals[cur_entry, :3] = normal_vote
-        new_normals[cur_entry, 3] = i
-        cur_entry += 1
-    return_dict[p_nr] = new_normals
+
+def _init_normal_voting_worker(shm_names, n_points, n_queries, neighbor_threshold, decay_param, len_thres):
+    """
+    Attaches a worker process to the shared point cloud and query positions / normals (input) and voted normals
+    (output), and builds the neighbor search tree once per worker.
+    """
+    shms = [shared_memory.SharedMemory(name=name) for name in shm_names]
+    shapes = [(n_points, 3), (n_points, 3), (n_queries, 3), (n_queries, 3), (n_queries, 3)]
+    arrays = [np.ndarray(shape, dtype=np.float64, buffer=shm.buf) for shape, shm in zip(shapes, shms)]
+    _normal_voting_shared['shms'] = shms
+    _normal_voting_shared['arrays'] = arrays
+    _normal_voting_shared['tree'] = cKDTree(arrays[0])
+    _normal_voting_shared['params'] = (neighbor_threshold, decay_param, len_thres)
+
+
+def _normal_voting_worker(chunk):
+    """
+    Performs normal voting for the query positions chunk[0]:chunk[1] and writes the results directly into the shared
+    output.
+    """
+    start, end = chunk
+    pos_array, normal_array, query_positions, query_normals, out_array = _normal_voting_shared['arrays']
+    neighbor_threshold, decay_param, len_thres = _normal_voting_shared['params']
+    for _, _, neighbor_idcs, neighbor_counts in _get_neighbor_chunks(_normal_voting_shared['tree'],
+                                                                     query_positions[start:end], neighbor_threshold,
+                                                                     chunk_size=end - start):
+        out_array[start:end] = _normal_voting_for_positions(pos_array, query_positions[start:end], normal_array,
+                                                             query_normals[start:end], neighbor_idcs, neighbor_counts,
+                                                             neighbor_threshold, decay_param, len_thres)
+    return end - start
+
+
+def _normal_voting_parallel(pos_array, normal_array, query_positions, query_normals, neighbor_threshold, decay_param,
+                            len_thres, npr, chunk_size=256):
+    """
+    Distributes chunks of query positions on a pool of npr processes (dynamically, so that processes finishing early
+    take over more chunks). All arrays are passed through shared memory, so no arrays are pickled.
+    """
+    n_points, n_queries = pos_array.shape[0], query_positions.shape[0]
+    inputs = [pos_array, normal_array, query_positions, query_normals, np.zeros((n_queries, 3))]
+    shms = [shared_memory.SharedMemory(create=True, size=max(array.size * np.dtype(np.float64).itemsize, 1))
+            for array in inputs]
+    try:
+        shared_arrays = [np.ndarray(array.shape, dtype=np.float64, buffer=shm.buf) for array, shm in zip(inputs, shms)]
+        for shared_array, array in zip(shared_arrays, inputs):
+            shared_array[:] = array
+
+        chunks = [(start, min(start + chunk_size, n_queries)) for start in range(0, n_queries, chunk_size)]
+        with mp.Pool(npr, initializer=_init_normal_voting_worker,
+                     initargs=([shm.name for shm in shms], n_points, n_queries, neighbor_threshold, decay_param,
+                               len_thres)) as pool:
+            done_points = 0
+            for num_points in pool.imap_unordered(_normal_voting_worker, chunks):
+                done_points += num_points
+                if done_points % 2560 < num_points:
+                    print(done_points, '/', n_queries)
+        new_normals = np.array(shared_arrays[-1])
+        del shared_arrays
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return new_normals
+
+
+class NormalVotingIndex(object):
+    """
+    Spatial index over a membrane point cloud (positions and normals) for voting normals at arbitrary query positions,
+    e.g. cluster centers. The KD-tree is built only once and can be queried many times.
+    """
+    def __init__(self, pos_array, normal_array):
+        self.pos_array = np.asarray(pos_array, dtype=np.float64)
+        self.normal_array = np.asarray(normal_array, dtype=np.float64)
+        self.tree = cKDTree(self.pos_array)
+
+    def vote(self, query_positions, neighbor_threshold, decay_param, len_thres, query_normals=None, npr=1):
+        """
+        Computes the voted normals at the query positions.
+        query_normals: normals used for orienting the voted normals; if None, the normal of the closest point of the
+        point cloud is used
+        npr: number of processes
+        """
+        query_positions = np.asarray(query_positions, dtype=np.float64)
+        if query_positions.shape[0] == 0 or self.pos_array.shape[0] == 0:
+            return np.zeros((query_positions.shape[0], 3))
+        if query_normals is None:
+            _, closest_idcs = self.tree.query(query_positions)
+            query_normals = self.normal_array[closest_idcs]
+        if npr > 1:
+            return _normal_voting_parallel(self.pos_array, self.normal_array, query_positions, query_normals,
+                                           neighbor_threshold, decay_param, len_thres, npr)
+
+        new_normals = np.zeros_like(query_positions)
+        for start, end, neighbor_idcs, neighbor_counts in _get_neighbor_chunks(self.tree, query_positions,
+                                                                               neighbor_threshold):
+            if start % 2560 == 0:
+                print(start, '/', query_positions.shape[0])
+            new_normals[start:end] = _normal_voting_for_positions(self.pos_array, query_positions[start:end],
+                                                                   self.normal_array, query_normals[start:end],
+                                                                   neighbor_idcs, neighbor_counts, neighbor_threshold,
+                                                                   decay_param, len_thres)
+        return new_normals
 
 
 def normal_voting_for_pos_and_normal_array(pos_array, normal_array, neighbor_threshold, decay_param, len_thres, compare_array=None, npr=1):
+    """
+    Normal voting for all points of a point cloud (pos_array, normal_array). If compare_array is given, normals are
+    voted at the positions pos_array, using the point cloud (compare_array, normal_array) instead (see
+    NormalVotingIndex).
+    """
     print('Processing', pos_array.shape[0], 'points')
-    new_normals = np.zeros_like(pos_array)
-    print('Computing distance matrix')
-    time_zero = time.time()
+    print('Building neighbor search tree')
     if compare_array is None:
-        dist_matrix = euclidean_distances(pos_array)
-    else:
-        dist_matrix = euclidean_distances(pos_array, compare_array)
-
-    if compare_array is None:
-        process_points_masks = _get_mp_split(pos_array.shape, npr)
-        processes = []
-        manager = mp.Manager()
-        return_dict = manager.dict()
-
-        for pr_id in range(npr):
-            pr = mp.Process(target=normal_voting_process,
-                            args=(pos_array, normal_array, process_points_masks, pr_id, return_dict, dist_matrix, compare_array, neighbor_threshold, decay_param, len_thres))
-            pr.start()
-            processes.append(pr)
-        for pr_id in range(npr):
-            pr = processes[pr_id]
-            pr.join()
-        unordered_normals = np.concatenate([return_dict[pr_id] for pr_id in range(npr)], 0)
-        order = np.array(unordered_normals[:, 3], dtype=np.int32)
-        new_normals = unordered_normals[:, :3][order]
-
-    else:
-        for i in range(pos_array.shape[0]):
-            if i % 2500 == 0:
-                print(i, '/', pos_array.shape[0])
-                # print 'these 500 took', time.time() - time_zero, 'seconds.'
-                time_zero = time.time()
-
-            temp_pos = pos_array[i]
-            temp_normal = normal_array[i]
-            distances = dist_matrix[i]
-
-            normal_vote = __normal_voting_for_single_position(compare_array, temp_pos, normal_array, temp_normal, distances,
-                                                                  neighbor_threshold,
-                                                                  decay_param, len_thres)
-            new_normals[i] = normal_vote
-    return new_normals
+        return NormalVotingIndex(pos_array, normal_array).vote(pos_array, neighbor_threshold, decay_param, len_thres,
+                                                               query_normals=normal_array, npr=npr)
+    return NormalVotingIndex(compare_array, normal_array).vote(pos_array, neighbor_threshold, decay_param, len_thres,
+                                                               npr=npr)
 
 
 def normal_voting_for_star(in_star, out_dir, npr=1):
@@ -5,12 +5,15 @@ import torch
 import math
 import h5py
 import time
+import hashlib
+import tempfile
 if not torch.cuda.is_available():
     # import pyto
     pass
 from utils import star_utils, data_utils
 import multiprocessing as mp
-from scipy.ndimage import rotate
+from scipy.ndimage import rotate, map_coordinates, spline_filter
+from scipy import fft as sp_fft
 from utils.rigid_3d import Rigid3D
 from config import *
 
@@ -24,20 +27,84 @@ def compute_all_Euler_angles(in_dir, out_dir, in_del=',', out_del=',', hasHeader
             compute_Euler_angles_for_normals(os.path.join(in_dir, file), os.path.join(out_dir, file), in_del=in_del,
                                              out_del=out_del, hasHeader=hasHeader)
 
-def rotate_vol_for_angles(volume, angs, svol_cent):
+def rotate_vol_for_angles(volume, angs, svol_cent, rot_matrix=None):
     """
     Rotate volume around svol_cent with Z-Y-Z Euler angles.
     @param volume: volume to rotate
     @param angs: Euler angles
     @param svol_cent: center to rotate around
+    @param rot_matrix: precomputed rotation matrix for angs (e.g. from Rigid3D.make_r_euler_batch); computed if None
     @return: rotated volume
     """
     r3d = Rigid3D()
-    r3d.q = r3d.make_r_euler(angles=np.radians(angs), mode='zyz_in_active')
+    if rot_matrix is None:
+        rot_matrix = r3d.make_r_euler(angles=np.radians(angs), mode='zyz_in_active')
+    r3d.q = rot_matrix
     particle = r3d.transformArray(volume, origin=svol_cent, order=3, prefilter=True)
     return particle
 
 
+def get_rotated_box_coords(rot_matrices, box_range):
+    """
+    Computes the sample coordinates of rotated boxes of size (2 * box_range)^3, relative to the box centers. These are
+    the coordinates of the central part of a rotated volume, i.e. the same as rotating a larger volume with
+    rotate_vol_for_angles and cropping the center.
+    @param rot_matrices: rotation matrices (N x 3 x 3)
+    @param box_range: half size of the boxes
+    @return: coordinate offsets (N x 3 x (2 * box_range)^3)
+    """
+    box_grid = np.mgrid[-box_range:box_range, -box_range:box_range, -box_range:box_range].reshape(3, -1)
+    # the volume is rotated by sampling at inversely rotated coordinates
+    return np.matmul(np.transpose(rot_matrices, (0, 2, 1)), box_grid.astype(np.float))
+
+
+def extract_rotated_subvolumes(tomo, centers, rot_matrices, box_range, spline_coeffs=None, batch_size=256):
+    """
+    Samples rotated subvolumes of size (2 * box_range)^3 directly from the tomogram, i.e. only the coordinates that
+    are kept in the end are interpolated (cubic splines).
+    @param tomo: tomogram
+    @param centers: integer voxel coordinates of the subvolume centers (N x 3); subvolumes of size
+    (4 * box_range + 1)^3 around them need to be inside the tomogram
+    @param rot_matrices: rotation matrices (N x 3 x 3), e.g. from Rigid3D.make_r_euler_batch
+    @param box_range: half size of the subvolumes
+    @param spline_coeffs: spline coefficients of the whole tomogram (see compute_spline_coefficients). If given, all
+    subvolumes of a batch are sampled in a single map_coordinates call. Otherwise, each subvolume is interpolated from
+    its surrounding cube, prefiltered separately (same result as rotate_vol_for_angles + cropping).
+    @param batch_size: number of subvolumes sampled at once
+    @return: subvolumes (N x 2 * box_range x 2 * box_range x 2 * box_range)
+    """
+    centers = np.asarray(centers, dtype=np.int64).reshape(-1, 3)
+    box_shape = (2 * box_range,) * 3
+    add_component = box_range * 2
+    subvolumes = np.zeros((centers.shape[0],) + box_shape, dtype=np.float32)
+    for start in range(0, centers.shape[0], batch_size):
+        end = min(start + batch_size, centers.shape[0])
+        offsets = get_rotated_box_coords(rot_matrices[start:end], box_range)
+        if spline_coeffs is not None:
+            coords = offsets + centers[start:end, :, np.newaxis]
+            coords = np.transpose(coords, (1, 0, 2)).reshape(3, -1)
+            values = map_coordinates(spline_coeffs, coords, order=3, mode='mirror', prefilter=False)
+            subvolumes[start:end] = values.reshape((end - start,) + box_shape)
+        else:
+            for i in range(start, end):
+                center = centers[i]
+                volume = tomo[center[0] - add_component: center[0] + add_component + 1,
+                              center[1] - add_component: center[1] + add_component + 1,
+                              center[2] - add_component: center[2] + add_component + 1]
+                values = map_coordinates(volume, offsets[i - start] + add_component, order=3, mode='constant',
+                                         prefilter=True)
+                subvolumes[i] = values.reshape(box_shape)
+    return subvolumes
+
+
+def compute_spline_coefficients(tomo):
+    """
+    Computes the cubic spline coefficients of the whole tomogram (once per tomogram), to be used for
+    extract_rotated_subvolumes.
+    """
+    return spline_filter(tomo, order=3, output=np.float32, mode='mirror')
+
+
 def eulerAnglesToRotationMatrix(theta):
     """
     Computes the rotation matrix for three Euler angles of the shape X-Y-Z
@@ -83,38 +150,22 @@ def compute_all_Euler_angles_for_star(in_star, out_dir, in_del=',', out_del=',',
 
 def compute_Euler_angle_for_single_normals_array(normals):
     """
-    Use a normal vector to compute corresponding Euler angles of shape Z-Y-Z
+    Use normal vectors (N x 3) to compute corresponding Euler angles of shape Z-Y-Z (N x 3)
     """
-    angles = []
-    for normal in normals:
-        rot, tilt, psi = vect_to_zrelion(-1 * normal)
-        angles.append([rot, tilt, psi])
-    return angles
+    normals = np.asarray(normals, dtype=np.float).reshape(-1, 3)
+    return vects_to_zrelion(-1 * normals)
 
 
 def compute_Euler_angles_for_normals(in_csv_path, out_csv_path, in_del=',', out_del=',', hasHeader=False):
     """
     For a csv file containing positions and normals, Z-Y-Z Euler angles are computed and stored into another csv file.
     """
-    points = []
-    normals = []
     print('Computing Euler Angles for file:', in_csv_path)
-    with open(in_csv_path) as in_csv_file:
-        csv_reader = csv.reader(in_csv_file, delimiter=in_del)
-        for i, row in enumerate(csv_reader):
-            if hasHeader and i == 0:
-                continue
-            points.append(np.array(row[:3], dtype=np.float))
-            normals.append(np.array(row[3:6], dtype=np.float))
-    angles = compute_Euler_angle_for_single_normals_array(normals)
-
+    data = np.loadtxt(in_csv_path, delimiter=in_del, skiprows=(1 if hasHeader else 0), usecols=range(6), ndmin=2)
+    angles = compute_Euler_angle_for_single_normals_array(data[:, 3:6])
+    out_rows = np.concatenate((data, angles), axis=1).tolist()
     with open(out_csv_path, 'w') as out_csv_file:
-        csv_writer = csv.writer(out_csv_file)
-        for i, point in enumerate(points):
-            point = point.tolist()
-            normal = normals[i].tolist()
-            angle = angles[i]
-            csv_writer.writerow(point + normal + angle)
+        out_csv_file.write(''.join(out_del.join(map(repr, row)) + '\r\n' for row in out_rows))
 
 
 def vect_to_zrelion(normal):
@@ -147,6 +198,39 @@ def vect_to_zrelion(normal):
         return rot, tilt, psi
 
 
+def vects_to_zrelion(normals):
+    """
+    Vectorized version of vect_to_zrelion for an array of vectors (N x 3), giving identical results.
+    Returns: array (N x 3) with the Euler angles (rot, tilt, psi) in Relion format
+    """
+    # same precision as in vect_to_zrelion: float32 normalization and angles, degree conversion in float64
+    v_m = np.asarray(normals, dtype=np.float32).reshape(-1, 3)
+    v_norm = np.sqrt(np.sum(v_m * v_m, axis=1).astype(np.float64)).astype(np.float32)
+    n = v_m / v_norm[:, np.newaxis]
+
+    alpha = np.arccos(n[:, 2]).astype(np.float64)
+    beta = np.arctan2(n[:, 1], n[:, 0]).astype(np.float64)
+
+    angles = np.zeros((v_m.shape[0], 3))
+    angles[:, 1] = unroll_angles(np.degrees(alpha), deg=True)
+    angles[:, 2] = unroll_angles(180. - np.degrees(beta), deg=True)
+    return angles
+
+
+def unroll_angles(angles, deg=True):
+    """
+    Vectorized version of unroll_angle for an array of angles.
+    """
+    angles = np.asarray(angles, dtype=np.float64)
+    if deg:
+        mx_ang, mx_ang2 = 360., 180.
+    else:
+        mx_ang, mx_ang2 = 2*np.pi, np.pi
+    ang_mod, ang_sgn = np.abs(angles), np.sign(angles)
+    ur_ang = ang_mod % mx_ang
+    return np.where(ur_ang > mx_ang2, -1. * ang_sgn * (mx_ang - ur_ang), ang_sgn * ur_ang)
+
+
 def unroll_angle(angle, deg=True):
     """
     copied from Antonio Martinez Sanchez' PySeg:
@@ -181,9 +265,48 @@ def mp_tomo_split(tomo_tokens, n_pr):
         tomo_lists[i % n_pr].append(tomo_token)
     return tomo_lists
 
+_rotation_shared = {}
+
+
+def _init_rotation_worker(rotator, tomo, spline_coeffs, box_range, pred_scale):
+    _rotation_shared['rotator'] = rotator
+    _rotation_shared['args'] = (box_range, tomo, pred_scale, spline_coeffs)
+
+
+def _rotation_worker(cur_lines):
+    return _rotation_shared['rotator'].rotate_lines(cur_lines, *_rotation_shared['args'])
+
+
+class H5SampleWriter(object):
+    """
+    Appends samples (e.g. subvolumes) to a resizable, chunked HDF5 dataset, so that data can be written as it is
+    produced instead of being collected in memory first.
+    compression: None, 'gzip', 'lzf' or 'lz4' (the latter needs the hdf5plugin package)
+    chunk_samples: number of samples per HDF5 chunk
+    """
+    def __init__(self, group, name, sample_shape, dtype=np.float64, chunk_samples=1024, compression=None):
+        sample_shape = tuple(sample_shape)
+        self.dataset = group.create_dataset(name, shape=(0,) + sample_shape, maxshape=(None,) + sample_shape,
+                                            chunks=(chunk_samples,) + sample_shape, dtype=dtype,
+                                            **data_utils.get_h5_compression_kwargs(compression))
+
+    def append(self, samples):
+        n_new = samples.shape[0]
+        if n_new == 0:
+            return
+        n_old = self.dataset.shape[0]
+        self.dataset.resize(n_old + n_new, axis=0)
+        self.dataset[n_old:] = samples
+
+    def __len__(self):
+        return self.dataset.shape[0]
+
+
 class Rotator(object):
     def __init__(self, rotation_dir, out_bins, pred_bin, box_range, settings, n_pr, pos_star=None,
-                       store_dir=None, store_normals=False, store_angles=False, preprocess_tomograms=True, lp_cutoff=None):
+                       store_dir=None, store_normals=False, store_angles=False, preprocess_tomograms=True, lp_cutoff=None,
+                       tomo_spline_coeffs=False, fft_workers=1, cache_dir=None, compression=None, batch_size=1024,
+                       storage_dtype=None):
         self.rotation_dir = rotation_dir
         self.out_bins = out_bins
         self.pred_bin = pred_bin
@@ -196,6 +319,12 @@ class Rotator(object):
         self.store_angles = store_angles
         self.preprocess_tomograms = preprocess_tomograms
         self.lp_cutoff = lp_cutoff
+        self.tomo_spline_coeffs = tomo_spline_coeffs
+        self.fft_workers = fft_workers
+        self.cache_dir = cache_dir
+        self.compression = compression
+        self.batch_size = batch_size
+        self.storage_dtype = storage_dtype
 
     def rotate_all_volumes(self):
         """
@@ -213,6 +342,14 @@ class Rotator(object):
         store_dir: If specified, sample volumes are stored in the directory to check the outcome subvolumes
         store_normals: If True, normal vectors are added to the output .h5 file
         store_angles: If True, Euler angles are added to the output .h5 file
+        tomo_spline_coeffs: If True (and rotation normalization is used), spline coefficients are computed once for
+        each tomogram instead of prefiltering each subvolume separately
+        fft_workers: number of threads used for the FFTs of low-pass filtering
+        cache_dir: If specified, preprocessed tomograms are stored in this directory and reused in later runs
+        compression: compression of the stored subvolumes (None, 'gzip', 'lzf' or 'lz4', see H5SampleWriter)
+        batch_size: number of positions that are processed and written to the .h5 file at once
+        storage_dtype: dtype of the stored subvolumes (e.g. 'float16', or 'uint8' / 'uint16' for quantized storage with
+        per-subvolume scales and offsets, see data_utils.quantize_subvolumes). If None, the dtype of the tomogram is used.
         """
         print("Start rotation")
         tomo_tokens = self.settings.tomo_tokens
@@ -242,11 +379,17 @@ class Rotator(object):
                 bin_group = f.create_group('bin' + str(out_bin))
                 box_range = self.box_ranges[nr]
                 tomo_path = tomo_paths_for_bin[tomo_token][out_bin]
-                tomo = data_utils.load_tomogram(tomo_path)
-                if self.preprocess_tomograms:
-                    tomo = preprocess_tomogram(tomo.copy(), lp_cutoff=self.lp_cutoff)
-                diff = np.max(tomo) - np.min(tomo)
-                tomo = (tomo - np.min(tomo)) / diff
+                tomo = load_preprocessed_tomogram(tomo_path, preprocess=self.preprocess_tomograms,
+                                                  lp_cutoff=self.lp_cutoff, fft_workers=self.fft_workers,
+                                                  cache_dir=self.cache_dir)
+                spline_coeffs = None
+                if USE_ROTATION_NORMALIZATION and self.tomo_spline_coeffs:
+                    spline_coeffs = compute_spline_coefficients(tomo)
+                if USE_ROTATION_NORMALIZATION:
+                    subvol_shape = (2 * box_range,) * 3
+                else:
+                    subvol_shape = (4 * box_range + 1,) * 3
+                storage_dtype = tomo.dtype if self.storage_dtype is None else np.dtype(self.storage_dtype)
                 for mb_nr, mb_token in enumerate(mb_tokens[tomo_token]):
                     if stack_tokens is not None:
                         stack_token = stack_tokens[tomo_token][mb_nr]
@@ -258,181 +401,94 @@ class Rotator(object):
                             continue
                         csv_path = pred_paths[tomo_token][mb_token]
                     time_zero = time.time()
-                    mb_volumes, mb_positions, mb_normals, mb_angles = \
-                        self._rotate_volumes_for_membrane_parallel(csv_path, box_range, out_bin,tomo=tomo)
-                    print('This took', time.time() - time_zero, 'seconds.')
 
                     mb_group = bin_group.create_group(stack_token + mb_token)
                     mb_group.create_dataset('tomo_token', shape=(1,), data=tomo_token)
                     mb_group.create_dataset('mb_token', shape=(1,), data=mb_token)
                     mb_group.create_dataset('stack_token', shape=(1,), data=stack_token)
                     mb_group.create_dataset('bin', shape=(1,), data=out_bin)
-                    mb_group.create_dataset('subvolumes', data=mb_volumes)
-                    mb_group.create_dataset('positions', data=mb_positions)
-                    if self.store_normals:
-                        mb_group.create_dataset('normals', data=mb_normals)
-                    if self.store_angles:
-                        mb_group.create_dataset('angles', data=mb_angles)
-
-    def _rotate_volumes_for_membrane_parallel(self, csv_path, box_range, out_bin, tomo=None):
+                    writers = [H5SampleWriter(mb_group, 'subvolumes', subvol_shape, dtype=storage_dtype, chunk_samples=1,
+                                              compression=self.compression),
+                               H5SampleWriter(mb_group, 'positions', (3,))]
+                    writers.append(H5SampleWriter(mb_group, 'normals', (3,)) if self.store_normals else None)
+                    writers.append(H5SampleWriter(mb_group, 'angles', (3,)) if self.store_angles else None)
+                    quantized = storage_dtype.kind != 'f'
+                    if quantized:
+                        writers.append(H5SampleWriter(mb_group, 'subvolume_scales', (), dtype=np.float32))
+                        writers.append(H5SampleWriter(mb_group, 'subvolume_offsets', (), dtype=np.float32))
+                    # subvolumes are written batch-wise as they are produced, so memory does not grow with the
+                    # membrane size
+                    for batch in self._rotate_volumes_for_membrane_parallel(csv_path, box_range, out_bin, tomo=tomo,
+                                                                            spline_coeffs=spline_coeffs):
+                        volumes, scales, offsets = data_utils.quantize_subvolumes(batch[0], storage_dtype)
+                        batch = (volumes,) + tuple(batch[1:]) + ((scales, offsets) if quantized else ())
+                        for writer, data in zip(writers, batch):
+                            if writer is not None:
+                                writer.append(data)
+                    print('This took', time.time() - time_zero, 'seconds.')
+
+    def _rotate_volumes_for_membrane_parallel(self, csv_path, box_range, out_bin, tomo=None, spline_coeffs=None):
+        """
+        Generator yielding (volumes, positions, normals, angles) for consecutive batches of the membrane's positions
+        (in the order of the positions file). Batches are processed by a pool of self.n_pr processes.
+        """
         pred_scale = self.pred_bin * 1.0 / out_bin
         tomo_token, mb_token = data_utils.get_tomo_and_mb_from_file_name(csv_path, self.settings)
         print("Processing subvolumes for Tomo: ", tomo_token, "  Membrane:", mb_token, "  Bin:", out_bin)
 
         all_lines = data_utils.get_csv_data(csv_path)
+        print('Converting', all_lines.shape[0], 'subvolumes.')
+        line_batches = [all_lines[start:start + self.batch_size]
+                        for start in range(0, all_lines.shape[0], self.batch_size)]
         if self.n_pr > 1:
-            parallel_mask = self._get_parallel_line_split(all_lines)
-            processes = []
-            manager = mp.Manager()
-            return_dict = manager.dict()
-            for pr_id in range(self.n_pr):
-                pr = mp.Process(target=self.rotate_parallel_split,
-                                args=(return_dict, all_lines, parallel_mask, pr_id, box_range, tomo,
-                                      tomo_token, mb_token, pred_scale))
-                pr.start()
-                processes.append(pr)
-            for pr_id in range(self.n_pr):
-                pr = processes[pr_id]
-                pr.join()
-            time_zero = time.time()
-            time_zero = time.time()
-
-            all_volumes = np.concatenate([return_dict[pr_id][0] for pr_id in range(self.n_pr)], 0)
-            all_positions = np.concatenate([return_dict[pr_id][1] for pr_id in range(self.n_pr)], 0)
-            all_normals = np.concatenate([return_dict[pr_id][2] for pr_id in range(self.n_pr)], 0)
-            all_angles = np.concatenate([return_dict[pr_id][3] for pr_id in range(self.n_pr)], 0)
-        else:
-            all_volumes, all_positions, all_normals, all_angles = self.rotate_parallel_split(None, all_lines, None, 0,
-                                                                                             box_range, tomo,
-                                                                                             tomo_token, mb_token,
-                                                                                             pred_scale)
-        return all_volumes, all_positions, all_normals, all_angles
-
-
-    def _get_parallel_line_split(self, all_lines):
-        """
-        Distributes all positions of a membrane on multiple processes.
-        @param all_lines: positions array
-        @type all_lines: numpy array
-        @param n_pr: number of processes
-        @type n_pr: int
-        @return: mask indicating the assigned processes
-        """
-        if self.n_pr == 1:
-            return np.zeros(all_lines.shape[0])
+            # the tomogram is inherited by the worker processes
+            with mp.Pool(self.n_pr, initializer=_init_rotation_worker,
+                         initargs=(self, tomo, spline_coeffs, box_range, pred_scale)) as pool:
+                for batch in pool.imap(_rotation_worker, line_batches):
+                    yield batch
         else:
-            out_mask = np.zeros(all_lines.shape[0])
-            step = int(all_lines.shape[0] / self.n_pr)
-            for i in range(self.n_pr - 1):
-                out_mask[i*step:(i+1)*step] = i
-            out_mask[(i+1) * step:] = self.n_pr - 1
-            return out_mask
+            for cur_lines in line_batches:
+                yield self.rotate_lines(cur_lines, box_range, tomo, pred_scale, spline_coeffs)
 
 
-    def rotate_parallel_split(self, return_dict, all_lines, line_mask, pr_id, box_range, tomo, tomo_token, mb_token, pred_scale):
+    def rotate_lines(self, cur_lines, box_range, tomo, pred_scale, spline_coeffs=None):
         """
-        Samples and rotates subvolumes and stores them into the return_dict
-        @param return_dict: Multiprocessing dictionary to store sampled subvolumes
-        @param all_lines: array containing positions, normals and angles
-        @param line_mask: mask indicating the assigned processes
-        @param pr_id: id of current process
-        @param store_normals: should normals be stored?
+        Samples and rotates subvolumes for the given positions. Positions whose boxes exceed the tomogram are skipped.
+        @param cur_lines: array containing positions, normals and angles
         @param box_range: extent of sampled subvolumes (box_range * 2)
         @param tomo: volumetric tomogram
-        @param store_dir: if specified, sampled volumes are stored here, in order to verify sampling
         @param pred_scale: scaling factor for positions, indicating whether they need to be multiplied (for binning)
-        @param store_angles: should angles be stored?
-
+        @param spline_coeffs: spline coefficients of the tomogram for rotation normalization (see
+        extract_rotated_subvolumes)
+        @return: volumes, positions, normals and angles arrays (normals / angles are empty if they are not stored)
         """
-        print()
-        print('Starting process', pr_id, '...')
-        print('This process needs to convert', np.sum(line_mask == pr_id), 'subvolumes.')
-        print()
-
-        if self.n_pr > 1:
-            cur_mask = line_mask == pr_id
-            cur_lines = all_lines[cur_mask]
-        else:
-            cur_lines = all_lines
         if USE_ROTATION_NORMALIZATION:
-            all_volumes = np.zeros((0, 2 * box_range, 2 * box_range, 2 * box_range))
+            subvol_shape = (2 * box_range,) * 3
         else:
-            all_volumes = np.zeros((0, 4 * box_range + 1, 4 * box_range + 1, 4 * box_range + 1))
-        all_positions = np.zeros((0, 3))
+            subvol_shape = (4 * box_range + 1,) * 3
         all_normals = np.zeros((0, 3))
         all_angles = np.zeros((0, 3))
 
-        particle_list = []
-        positions_list = []
-        if self.store_angles:
-            angles_list = []
-        if self.store_normals:
-            normals_list = []
-        for i, line in enumerate(cur_lines):
-            positions = np.expand_dims(np.array([float(line[0]), float(line[1]), float(line[2])]), 0) * pred_scale
-            positions = np.squeeze(positions)
-            angles = np.array([float(line[6]), float(line[7]), float(line[8])])
-
-            add_component = box_range * 2
-            if not self.check_in_range(positions, add_component, tomo.shape):
-                continue
-
-            if self.store_angles:
-                angles_list.append(angles)
-            if self.store_normals:
-                normals = np.array([float(line[3]), float(line[4]), float(line[5])])
-                normals_list.append(normals)
-
-            volume = tomo[int(round(positions[0]) - add_component): int(round(positions[0]) + add_component) + 1,
-                     int(round(positions[1]) - add_component): int(round(positions[1]) + add_component) + 1,
-                     int(round(positions[2]) - add_component): int(round(positions[2]) + add_component) + 1]
-            if USE_ROTATION_NORMALIZATION:
-                coord, angs = positions, angles
-                svol_cent = np.array([add_component] * 3)
-                particle = rotate_vol_for_angles(volume, angs, svol_cent)
-                particle_cen = [add_component] * 3
-                particle = particle[int(particle_cen[0] - box_range):int(particle_cen[0] + box_range),
-                           int(particle_cen[1] - box_range):int(particle_cen[1] + box_range),
-                           int(particle_cen[2] - box_range):int(particle_cen[2] + box_range)]
-            else:
-                particle = volume
-            positions_list.append(positions)
-            particle_list.append(particle)
-            # if self.store_dir is not None:
-            #     filename = os.path.join(self.store_dir, tomo_token + mb_token + '_' + str(i) + '_centervol.mrc')
-            #     data_utils.store_tomogram(filename, particle)
+        cur_lines = np.array(cur_lines, dtype=np.float)
+        positions = cur_lines[:, 0:3] * pred_scale
+        centers = np.round(positions).astype(np.int64)
+        add_component = box_range * 2
+        valid = data_utils.get_valid_box_mask(centers, add_component, add_component + 1, tomo.shape)
+        if not np.any(valid):
+            return np.zeros((0,) + subvol_shape, dtype=tomo.dtype), np.zeros((0, 3)), all_normals, all_angles
+        cur_lines, positions, centers = cur_lines[valid], positions[valid], centers[valid]
+        if USE_ROTATION_NORMALIZATION:
+            # only the kept (2 * box_range)^3 rotated coordinates are sampled
+            rot_matrices = Rigid3D.make_r_euler_batch(np.radians(cur_lines[:, 6:9]), mode='zyz_in_active')
+            all_volumes = extract_rotated_subvolumes(tomo, centers, rot_matrices, box_range,
+                                                     spline_coeffs=spline_coeffs)
+        else:
+            all_volumes = data_utils.extract_subvolumes(tomo, centers, add_component, subvol_shape[0])
         if self.store_angles:
-            temp_angles = np.stack(angles_list, axis=0)
-            all_angles = np.concatenate((all_angles, temp_angles), 0)
+            all_angles = cur_lines[:, 6:9]
         if self.store_normals:
-            temp_normals = np.stack(normals_list, axis=0)
-            all_normals = np.concatenate((all_normals, temp_normals), 0)
-        temp_volumes = np.stack(particle_list, axis=0)
-        temp_positions = np.stack(positions_list, axis=0)
-        all_volumes = np.concatenate((all_volumes, temp_volumes), 0)
-        all_positions = np.concatenate((all_positions, temp_positions), 0)
-        if self.n_pr > 1:
-            return_dict[pr_id] = [all_volumes, all_positions, all_normals, all_angles]
-        else:
-            return all_volumes, all_positions, all_normals, all_angles
-
-    def check_in_range(self, positions, add_component, tomo_shape):
-        """
-        Checks whether the sampled box around the given positions array is within the range of the tomogram.
-        @param positions: positional array (3-dim)
-        @param add_component: int specifying the extent of sampled box
-        @type add_component: int
-        @param tomo_shape: shape of the tomogram
-        @type tomo_shape: list of ints (len 3)
-        @return: indicator whether the sampled box is valid or not
-        @rtype: bool
-        """
-        valid = True
-        for j in range(3):
-            if int(round(positions[j]) - add_component) < 0 or int(round(positions[j]) + add_component) + 1 >= \
-                    tomo_shape[j]:
-                valid = False
-        return valid
+            all_normals = cur_lines[:, 3:6]
+        return all_volumes, positions, all_normals, all_angles
 
     # def rotate_vol_for_angles(self, volume, angs, svol_cent):
     #     """
@@ -538,22 +594,161 @@ def clamp_values_from_std_tomo(tomo):
     return tomo
 
 
-def perform_low_pass_filtering(tomo, cutoff=0.05):
-    fft_tomo = np.fft.fftn(tomo)
-    fft_tomo = np.fft.fftshift(fft_tomo)
-    fft_tomo = gaussianLP_of_fft(fft_tomo, cutoff)
-    # fft_tomo = gaussianHP_of_fft(fft_tomo, 0.2)
-    fft_tomo_shift = np.fft.ifftshift(fft_tomo)
-    tomo2 = np.fft.ifftn(fft_tomo_shift)
+def gaussianLP_weights_rfft(shape, cutoff_freq, dtype=np.float32):
+    """
+    Separable Gaussian low-pass weights for the half-spectrum returned by rfftn. The Gaussian is centered on the zero
+    frequency and has the same width (1 / cutoff_freq frequency bins) as gaussianLP_of_fft.
+    Returns one 1D weight vector per axis, shaped for broadcasting against the rfftn output.
+    """
+    D0 = 1 / cutoff_freq
+    weights = []
+    for axis, n in enumerate(shape):
+        if axis == len(shape) - 1:
+            freqs = sp_fft.rfftfreq(n) * n
+        else:
+            freqs = sp_fft.fftfreq(n) * n
+        weight = np.exp(-(freqs * freqs) / (2 * D0**2)).astype(dtype)
+        bc_shape = [1] * len(shape)
+        bc_shape[axis] = weight.shape[0]
+        weights.append(weight.reshape(bc_shape))
+    return weights
+
+
+def perform_low_pass_filtering(tomo, cutoff=0.05, workers=1):
+    """
+    Gaussian low-pass filtering of a tomogram via a real-valued FFT in single precision.
+    workers: number of threads used by scipy.fft
+    """
+    tomo = np.asarray(tomo, dtype=np.float32)
+    fft_tomo = sp_fft.rfftn(tomo, workers=workers)
+    for weight in gaussianLP_weights_rfft(tomo.shape, cutoff, dtype=np.float32):
+        fft_tomo *= weight
+    tomo2 = sp_fft.irfftn(fft_tomo, s=tomo.shape, workers=workers, overwrite_x=True)
     return tomo2
 
 
-def preprocess_tomogram(tomo, lp_cutoff=None):
+def _tomogram_chunks(tomo, chunk_size=None):
+    """
+    Yields views on consecutive slabs of the tomogram, split along the axis with the largest stride (so that each
+    slab is a contiguous block of memory).
+    """
+    if chunk_size is None:
+        yield tomo
+        return
+    axis = int(np.argmax(np.abs(tomo.strides)))
+    for start in range(0, tomo.shape[axis], chunk_size):
+        idx = [slice(None)] * tomo.ndim
+        idx[axis] = slice(start, start + chunk_size)
+        yield tomo[tuple(idx)]
+
+
+def tomogram_statistics(tomo, chunk_size=None):
+    """
+    Computes mean, standard deviation, minimum and maximum of the tomogram in a single streaming pass.
+    Chunks are accumulated in float64 and merged with the pairwise update formula for the variance.
+    """
+    count, mean, m2 = 0, 0., 0.
+    t_min, t_max = np.inf, -np.inf
+    for chunk in _tomogram_chunks(tomo, chunk_size):
+        chunk64 = np.asarray(chunk, dtype=np.float64)
+        n = chunk64.size
+        if n == 0:
+            continue
+        c_mean = np.mean(chunk64)
+        c_m2 = np.sum(np.square(chunk64 - c_mean))
+        delta = c_mean - mean
+        mean += delta * n / (count + n)
+        m2 += c_m2 + delta * delta * count * n / (count + n)
+        count += n
+        t_min = min(t_min, np.min(chunk))
+        t_max = max(t_max, np.max(chunk))
+    std = np.sqrt(m2 / count)
+    return mean, std, float(t_min), float(t_max)
+
+
+def normalize_tomogram(tomo, standardize=True, chunk_size=32):
+    """
+    Normalizes the tomogram to the range [0, 1] in place (float32), using one pass for the statistics and one pass for
+    the normalization.
+    If standardize is True, values are standardized and clamped to +-3 std before the min-max normalization
+    (same as standardize_tomogram, clamp_values_from_std_tomo and normalize_tomo, without intermediate copies).
+    The tomogram is converted to float32 first if needed (only copy made).
+    """
+    tomo = np.asarray(tomo, dtype=np.float32)
+    if not tomo.flags.writeable:
+        tomo = tomo.copy()
+    mean, std, t_min, t_max = tomogram_statistics(tomo, chunk_size=chunk_size)
+    if standardize:
+        # standardization is monotonic, so the extremes of the clamped tomogram follow from the raw extremes
+        lower = np.clip((t_min - mean) / std, -3., 3.)
+        upper = np.clip((t_max - mean) / std, -3., 3.)
+    for chunk in _tomogram_chunks(tomo, chunk_size):
+        if standardize:
+            chunk -= mean
+            chunk /= std
+            np.clip(chunk, -3., 3., out=chunk)
+            chunk -= lower
+            chunk /= (upper - lower)
+        else:
+            chunk -= t_min
+            chunk /= (t_max - t_min)
+    return tomo
+
+
+def preprocess_tomogram(tomo, lp_cutoff=None, fft_workers=1, chunk_size=32):
+    """
+    Optional low-pass filtering, followed by standardization, clamping to +-3 std and min-max normalization
+    (in place, float32).
+    """
     print("Preprocessing.")
     if lp_cutoff is not None:
-        print("Performing low-pass filtering. May take a couple of minutes.")
-        tomo = perform_low_pass_filtering(tomo, cutoff=lp_cutoff)
-    tomo = standardize_tomogram(tomo)
-    tomo = clamp_values_from_std_tomo(tomo)
+        print("Performing low-pass filtering.")
+        tomo = perform_low_pass_filtering(tomo, cutoff=lp_cutoff, workers=fft_workers)
+    tomo = normalize_tomogram(tomo, standardize=True, chunk_size=chunk_size)
     return tomo
 
+
+def _preprocessing_cache_path(tomo_path, cache_dir, preprocess, lp_cutoff):
+    """
+    Path of the cached preprocessed tomogram. The key combines the source file (path, size, modification time) with
+    the preprocessing parameters, so the cache entry becomes invalid if any of them changes.
+    """
+    stat = os.stat(tomo_path)
+    key = repr((os.path.abspath(tomo_path), stat.st_size, stat.st_mtime_ns, bool(preprocess),
+                None if lp_cutoff is None else float(lp_cutoff), 'v1'))
+    key_hash = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(tomo_path))[0]
+    return os.path.join(cache_dir, stem + '_' + key_hash + '.mrc')
+
+
+def load_preprocessed_tomogram(tomo_path, preprocess=True, lp_cutoff=None, fft_workers=1, cache_dir=None):
+    """
+    Loads a tomogram and normalizes it to [0, 1] (if preprocess is True, after optional low-pass filtering,
+    standardization and clamping, see preprocess_tomogram).
+    If cache_dir is specified, the result is stored there as float32 .mrc file and loaded directly in later calls with
+    the same tomogram and parameters.
+    """
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = _preprocessing_cache_path(tomo_path, cache_dir, preprocess, lp_cutoff)
+        if os.path.isfile(cache_path):
+            print("Using cached preprocessed tomogram:", cache_path)
+            return data_utils.load_tomogram(cache_path)
+    tomo = data_utils.load_tomogram(tomo_path)
+    if preprocess:
+        tomo = preprocess_tomogram(tomo, lp_cutoff=lp_cutoff, fft_workers=fft_workers)
+    else:
+        tomo = normalize_tomogram(tomo, standardize=False)
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a unique temporary file first, so that interrupted or concurrent runs do not leave incomplete
+        # cache entries
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.mrc.tmp', delete=False) as tmp_file:
+            tmp_path = tmp_file.name
+        try:
+            data_utils.store_tomogram(tmp_path, tomo)
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+    return tomo
@@ -2,11 +2,12 @@ import numpy as np
 from utils import star_utils, data_utils
 from skimage.measure import label
 from scipy.ndimage.morphology import distance_transform_edt, binary_dilation
-from scipy.ndimage.filters import convolve
-from scipy.spatial import distance_matrix
+from scipy.ndimage import find_objects
+from scipy.spatial import cKDTree
 from sklearn.linear_model import LinearRegression
 import os
-from time import time
+import multiprocessing as mp
+from multiprocessing import shared_memory
 
 def _get_out_star_dict():
     """
@@ -57,13 +58,14 @@ def normalize_vecs(vectors):
     return normed_vectors
 
 
-def _extrapolate(temp_seg, conn_comp_idcs, max_mb_dst):
+def _extrapolation_lines(slice_shape, conn_comp_idcs, max_mb_dst):
     """
-    Extrapolates a given segmentation of a membrane on both sides in order "cut" the surrounding area in two halves.
+    Computes the pixel coordinates of the lines extrapolating the membrane ends (see _extrapolate).
 
-    temp_seg: slice of a membrane segmentation
+    slice_shape: shape of the membrane segmentation slice
     conn_comp_idcs: indices corresponding to the membrane points of the current connected component
     max_mb_dst: radius of considered field around membranes (determines the radius of picked points)
+    Returns: coordinates (2 x N) of both extrapolated ends
     """
     dist_x = np.max(conn_comp_idcs[:, 0]) - np.min(conn_comp_idcs[:, 0])
     dist_y = np.max(conn_comp_idcs[:, 1]) - np.min(conn_comp_idcs[:, 1])
@@ -92,12 +94,12 @@ def _extrapolate(temp_seg, conn_comp_idcs, max_mb_dst):
 
         y_vals_max.reverse()
         min_start_x = np.maximum(np.min(conn_comp_idcs[:, 0]) - (10 + max_mb_dst), 0)
-        max_end_x = np.minimum(np.max(conn_comp_idcs[:, 0]) + 10 + max_mb_dst, temp_seg.shape[0])
-        new_ys_min = _extrapolate_linearly_1D(x_vals_min, y_vals_min, [range(min_start_x, np.minimum(np.min(conn_comp_idcs[:, 0]) + 10, temp_seg.shape[0] - 1))])
+        max_end_x = np.minimum(np.max(conn_comp_idcs[:, 0]) + 10 + max_mb_dst, slice_shape[0])
+        new_ys_min = _extrapolate_linearly_1D(x_vals_min, y_vals_min, [range(min_start_x, np.minimum(np.min(conn_comp_idcs[:, 0]) + 10, slice_shape[0] - 1))])
         new_ys_max = _extrapolate_linearly_1D(x_vals_max, y_vals_max, [range(np.maximum(np.max(conn_comp_idcs[:, 0] - 10), 0), max_end_x)])
 
-        new_ys_min = np.minimum(np.maximum(np.around(new_ys_min), 1), temp_seg.shape[1]-1)
-        new_ys_max = np.minimum(np.maximum(np.around(new_ys_max), 1), temp_seg.shape[1]-1)
+        new_ys_min = np.minimum(np.maximum(np.around(new_ys_min), 1), slice_shape[1]-1)
+        new_ys_max = np.minimum(np.maximum(np.around(new_ys_max), 1), slice_shape[1]-1)
         inds_min = np.array(range(min_start_x, np.min(conn_comp_idcs[:, 0] + 10)))
         inds_max = np.array(range(np.max(conn_comp_idcs[:, 0] - 10), max_end_x))
 
@@ -133,14 +135,14 @@ def _extrapolate(temp_seg, conn_comp_idcs, max_mb_dst):
         x_vals_max.reverse()
 
         min_start_y = np.maximum(np.min(conn_comp_idcs[:, 1]) - (10 + max_mb_dst), 0)
-        max_end_y = np.minimum(np.max(conn_comp_idcs[:, 1]) + 10 + max_mb_dst, temp_seg.shape[1])
+        max_end_y = np.minimum(np.max(conn_comp_idcs[:, 1]) + 10 + max_mb_dst, slice_shape[1])
         new_xs_min = _extrapolate_linearly_1D(y_vals_min, x_vals_min, [
-            range(min_start_y, np.minimum(np.min(conn_comp_idcs[:, 1]) + 10, temp_seg.shape[1] - 1))])
+            range(min_start_y, np.minimum(np.min(conn_comp_idcs[:, 1]) + 10, slice_shape[1] - 1))])
         new_xs_max = _extrapolate_linearly_1D(y_vals_max, x_vals_max,
                                               [range(np.maximum(np.max(conn_comp_idcs[:, 1] - 10), 0), max_end_y)])
 
-        new_xs_min = np.minimum(np.maximum(np.around(new_xs_min), 1), temp_seg.shape[0] - 1)
-        new_xs_max = np.minimum(np.maximum(np.around(new_xs_max), 1), temp_seg.shape[0] - 1)
+        new_xs_min = np.minimum(np.maximum(np.around(new_xs_min), 1), slice_shape[0] - 1)
+        new_xs_max = np.minimum(np.maximum(np.around(new_xs_max), 1), slice_shape[0] - 1)
         inds_min = np.array(range(min_start_y, np.min(conn_comp_idcs[:, 1] + 10)))
         inds_max = np.array(range(np.max(conn_comp_idcs[:, 1] - 10), max_end_y))
 
@@ -155,10 +157,35 @@ def _extrapolate(temp_seg, conn_comp_idcs, max_mb_dst):
         coords_min = np.stack((new_xs_min, inds_min), axis=1).transpose()
         coords_max = np.stack((new_xs_max, inds_max), axis=1).transpose()
 
-    temp_segregation_mask = np.zeros_like(temp_seg)
-    temp_segregation_mask[tuple(np.array(coords_min, dtype=np.int))] = 1
+    # lines running along the upper border would otherwise be shifted out of the array by the +1 offset
+    max_coords = np.expand_dims(np.array(slice_shape) - 1, 1)
+    coords_min = np.minimum(np.array(coords_min, dtype=np.int), max_coords)
+    coords_max = np.minimum(np.array(coords_max, dtype=np.int), max_coords)
+    return coords_min, coords_max
+
+
+def _extrapolate(temp_seg, conn_comp_idcs, max_mb_dst, box_offset=None, slice_shape=None):
+    """
+    Extrapolates a given segmentation of a membrane on both sides in order "cut" the surrounding area in two halves.
+
+    temp_seg: slice of a membrane segmentation
+    conn_comp_idcs: indices corresponding to the membrane points of the current connected component
+    max_mb_dst: radius of considered field around membranes (determines the radius of picked points)
+    box_offset: if temp_seg is only a box cropped from the slice, offset of this box; conn_comp_idcs are then given in
+    slice coordinates
+    slice_shape: shape of the full slice (only needed together with box_offset)
+    """
+    if slice_shape is None:
+        slice_shape = temp_seg.shape
+    coords_min, coords_max = _extrapolation_lines(slice_shape, conn_comp_idcs, max_mb_dst)
+    coords = np.concatenate((coords_min, coords_max), axis=1)
+    if box_offset is not None:
+        coords = coords - np.expand_dims(box_offset, 1)
+        in_box = np.all(np.logical_and(coords >= 0, coords < np.expand_dims(temp_seg.shape, 1)), axis=0)
+        coords = coords[:, in_box]
 
-    temp_segregation_mask[tuple(np.array(coords_max, dtype=np.int))] = 1
+    temp_segregation_mask = np.zeros_like(temp_seg)
+    temp_segregation_mask[tuple(coords)] = 1
     temp_segregation_mask = binary_dilation(temp_segregation_mask)
 
     segregation_mask = temp_seg
@@ -166,28 +193,318 @@ def _extrapolate(temp_seg, conn_comp_idcs, max_mb_dst):
 
     return segregation_mask
 
+def _linear_voxel_idcs(coords1, coords2):
+    """
+    Converts two arrays of integer voxel coordinates (row-wise) into linear (raveled) indices of a common grid that
+    encloses both of them. Equal coordinates are mapped to equal linear indices.
+    """
+    coords1 = np.asarray(coords1, dtype=np.int64)
+    coords2 = np.asarray(coords2, dtype=np.int64)
+    all_coords = np.concatenate((coords1, coords2), axis=0)
+    offset = np.min(all_coords, axis=0)
+    grid_shape = tuple(np.max(all_coords, axis=0) - offset + 1)
+    lin_idcs1 = np.ravel_multi_index(tuple((coords1 - offset).T), grid_shape)
+    lin_idcs2 = np.ravel_multi_index(tuple((coords2 - offset).T), grid_shape)
+    return lin_idcs1, lin_idcs2
+
+
 def _ismember(coords1, coords2):
     """
     Computes a mask indicating of size coords1.shape[0], indicating whether the coords of coords1 are contained in
     coords2 (row-wise)
+    Coordinates are compared via their linear voxel indices, i.e. in O(N + M) memory instead of building an N x M x 3
+    comparison tensor.
     """
-    mask = (coords1[:, None] == coords2).all(-1).any(-1)
+    if coords1.shape[0] == 0 or coords2.shape[0] == 0:
+        return np.zeros(coords1.shape[0], dtype=bool)
+    lin_idcs1, lin_idcs2 = _linear_voxel_idcs(coords1, coords2)
+    mask = np.isin(lin_idcs1, lin_idcs2)
     return mask
 
 
-def _find_batch_points(new_mb_points, point_batch):
-    point_batch = np.array(point_batch)
-    idcs = np.argwhere(_ismember(new_mb_points, point_batch))
-    cur_mb_points = new_mb_points[tuple(idcs.T)]
-    points_idcs_list = []
-    for i in range(point_batch.shape[0]):
-        cur_point = point_batch[i, :]
-        cur_idcs = idcs[np.all(cur_mb_points == cur_point, axis=1)]
-        points_idcs_list.append(cur_idcs)
-    return points_idcs_list
+def _average_longest_vectors(points, vecs, dists):
+    """
+    Groups the vectors by their (voxel) start points and averages, for each point, the vectors with maximal length.
+    Grouping is done by sorting the linear voxel indices, so all reductions are vectorized.
+
+    points: integer coordinates of the start points (row-wise, may contain duplicates)
+    vecs: vectors belonging to the points
+    dists: lengths of the vectors
+    Returns: unique points (lexicographically sorted) and their averaged longest vectors
+    """
+    lin_points, _ = _linear_voxel_idcs(points, points[:1])
+    _, first_idcs, group_idcs = np.unique(lin_points, return_index=True, return_inverse=True)
+    n_groups = first_idcs.shape[0]
+
+    max_dists = np.full(n_groups, -np.inf)
+    np.maximum.at(max_dists, group_idcs, dists)
+    longest_mask = dists == max_dists[group_idcs]
+
+    longest_counts = np.bincount(group_idcs[longest_mask], minlength=n_groups)
+    vec_sums = np.zeros((n_groups, vecs.shape[1]))
+    for dim in range(vecs.shape[1]):
+        vec_sums[:, dim] = np.bincount(group_idcs[longest_mask], weights=vecs[longest_mask, dim], minlength=n_groups)
+    avg_longest_vecs = vec_sums / longest_counts[:, np.newaxis]
+    return points[first_idcs], avg_longest_vecs
+
+
+def _thin_points(points, min_dist=1.5, seed=None):
+    """
+    Thins out a point cloud (Poisson-disk like): Points are visited in random order and a point is kept if no
+    previously kept point lies closer than min_dist. Thus, all kept points have a distance of at least min_dist to each
+    other, and each removed point lies closer than min_dist to a kept point.
+    Neighbors are looked up via a KD-tree, so this runs in near-linear time.
+
+    points: array of point coordinates (row-wise)
+    min_dist: minimum spacing between kept points
+    seed: seed for the random visiting order (if None, a random seed is used)
+    Returns: boolean mask of kept points
+    """
+    keep_mask = np.zeros(points.shape[0], dtype=bool)
+    if points.shape[0] == 0:
+        return keep_mask
+    removed_mask = np.zeros(points.shape[0], dtype=bool)
+    tree = cKDTree(points)
+    # query_ball_point includes points at exactly r; we want strictly closer than min_dist
+    neighbor_lists = tree.query_ball_point(points, r=np.nextafter(min_dist, 0))
+    rng = np.random.default_rng(seed)
+    for idx in rng.permutation(points.shape[0]):
+        if removed_mask[idx]:
+            continue
+        keep_mask[idx] = True
+        removed_mask[neighbor_lists[idx]] = True
+    return keep_mask
+
+
+def _box_counts(volume, box_size=7):
+    """
+    Counts the nonzero voxels of a binary volume in a cubic box around each voxel. Borders are treated like in
+    scipy.ndimage.convolve (mode 'reflect'), so the result equals a convolution with a box kernel of ones.
+    The box sum is separable and is computed axis by axis via integer cumulative sums.
+    """
+    half = box_size // 2
+    counts = np.array(volume, dtype=np.int32)
+    for axis in range(counts.ndim):
+        axis_counts = np.moveaxis(counts, axis, 0)
+        pad_width = [(half, half)] + [(0, 0)] * (counts.ndim - 1)
+        cum_counts = np.cumsum(np.pad(axis_counts, pad_width, mode='symmetric'), axis=0, dtype=np.int32)
+        box_sums = cum_counts[box_size - 1:].copy()
+        box_sums[1:] -= cum_counts[:-box_size]
+        counts = np.moveaxis(box_sums, 0, axis)
+    return counts
+
+
+def _shrink_membrane_borders(mb_mask, shrink_thres, box_size=7, iterations=3):
+    """
+    Iteratively removes membrane voxels that have too few membrane neighbors, i.e. shrinks the membrane from its edges.
+    In each iteration, a voxel is kept if more than shrink_thres voxels in the box around it are kept membrane voxels.
+    Only the bounding box of the membrane (plus half a box size) is processed.
+
+    mb_mask: binary membrane segmentation
+    shrink_thres: minimum number of neighboring membrane voxels
+    Returns: binary mask of the remaining membrane voxels
+    """
+    shrunk_mask = np.zeros(mb_mask.shape, dtype=bool)
+    if not np.any(mb_mask):
+        return shrunk_mask
+    half = box_size // 2
+    crop = []
+    for axis in range(mb_mask.ndim):
+        other_axes = tuple(ax for ax in range(mb_mask.ndim) if ax != axis)
+        axis_idcs = np.flatnonzero(np.any(mb_mask, axis=other_axes))
+        crop.append(slice(max(axis_idcs[0] - half, 0), min(axis_idcs[-1] + half + 1, mb_mask.shape[axis])))
+    crop = tuple(crop)
+
+    # voxels outside the membrane bounding box are zero, so cropping does not change the counts of membrane voxels
+    mb_crop = mb_mask[crop]
+    keep_mask = mb_crop
+    for i in range(iterations):
+        keep_mask = np.logical_and(mb_crop, _box_counts(keep_mask, box_size) > shrink_thres)
+    shrunk_mask[crop] = keep_mask
+    return shrunk_mask
+
+
+def _get_segmentation_side_for_slice(seg_slice, max_mb_dist, mb_ht, orig_pos):
+    """
+    Segments the surrounding of the membrane on the correct side for a single z-slice.
+    Each connected component is processed only within its bounding box, padded by the considered surrounding, since
+    no pixels further away from the component are used.
+    seg_slice: 2D slice of the (cropped) binary membrane segmentation
+    max_mb_dist, mb_ht, orig_pos: see _get_segmentation_side
+    Returns: 2D label slice (1: membrane, 2: correct side)
+    """
+    H = np.zeros(seg_slice.shape)
+    if np.sum(seg_slice) < 5:
+        return H
+    conn_comp_array, tot_conn_comps = label(seg_slice, return_num=True, connectivity=2)
+    conn_comp_boxes = find_objects(conn_comp_array)
+
+    # extra padding keeps the box border (where extrapolated lines are cut off) out of the considered surrounding
+    box_pad = int(np.ceil(max_mb_dist + mb_ht)) + 2
+    mb_mask = np.zeros(seg_slice.shape, dtype=bool)
+
+    for conn_comp_nr in range(1, tot_conn_comps + 1):
+        box = tuple(slice(max(comp_slice.start - box_pad, 0), min(comp_slice.stop + box_pad, dim))
+                    for comp_slice, dim in zip(conn_comp_boxes[conn_comp_nr - 1], seg_slice.shape))
+        box_offset = np.array([box_slice.start for box_slice in box])
+        conn_comp_box = conn_comp_array[box] == conn_comp_nr
+
+        ## Get all points in the surrounding of the membrane segmentation
+        H = np.zeros(seg_slice.shape)
+        dist_trafo, mb_idcs = distance_transform_edt(np.logical_not(conn_comp_box), return_indices=True)
+        mb_mask[box] |= dist_trafo <= mb_ht
+        H_temp = np.zeros(conn_comp_box.shape)
+        H_temp[dist_trafo <= (max_mb_dist + mb_ht)] = 2
+        H_temp[dist_trafo <= mb_ht] = 1
+
+        ## Separate the surrounding using extrapolation of the membrane ends
+        segregation_mask = _extrapolate(H_temp, np.argwhere(conn_comp_box) + box_offset, max_mb_dist,
+                                        box_offset=box_offset, slice_shape=seg_slice.shape)
+        mask = (H_temp == 2) * 1.0
+        mask[segregation_mask == 1] = 2
+        conn_comps_seg, conn_comps_seg_num = label(mask == 1, return_num=True)
+        if conn_comps_seg_num != 2:
+            print("WARNING! The membrane sides are not separated properly! Check whether sampled points are correct.")
+
+        """ Extract indices, their connection vectors to the membranes and the connection vectors to the origin point
+        Compare these two vectors using the dot product
+        Intention: If the dot product is high, the vectors point in the same direction"""
+
+        half1_idcs = np.argwhere(conn_comps_seg == 1)
+        half2_idcs = np.argwhere(conn_comps_seg == 2)
+        surr_coords = np.concatenate((half1_idcs, half2_idcs), axis=0)
+        mb_idcs = np.transpose(mb_idcs, (1, 2, 0))
+
+        vec_conn_mb = surr_coords - mb_idcs[tuple(surr_coords.T)]
+        vec_conn_mb = normalize_vecs(vec_conn_mb)
+
+        vec_conn_cen = surr_coords + box_offset - orig_pos[:2]
+        vec_conn_cen = normalize_vecs(vec_conn_cen)
+
+        dots = np.einsum('ij,ij->i', vec_conn_cen, vec_conn_mb)
+
+        dots_comp1 = dots[:half1_idcs.shape[0]]
+        dots_comp2 = dots[half1_idcs.shape[0]:]
+        if np.mean(dots_comp1) < np.mean(dots_comp2):
+            idcs_choice = half1_idcs
+        else:
+            idcs_choice = half2_idcs
+        H[tuple((idcs_choice + box_offset).T)] = 2
+
+    # the per-component distance maps already cover the membrane thickness, so no additional EDT is needed
+    H[mb_mask] = 1
+    return H
+
+
+_side_seg_shared = {}
+
+
+def _init_side_segmentation_worker(seg_shm_name, out_shm_name, shape, max_mb_dist, mb_ht, orig_pos):
+    """
+    Attaches a worker process to the shared segmentation (input) and label volume (output).
+    """
+    seg_shm = shared_memory.SharedMemory(name=seg_shm_name)
+    out_shm = shared_memory.SharedMemory(name=out_shm_name)
+    _side_seg_shared['shms'] = (seg_shm, out_shm)
+    _side_seg_shared['seg'] = np.ndarray(shape, dtype=bool, buffer=seg_shm.buf)
+    _side_seg_shared['out'] = np.ndarray(shape, dtype=np.float64, buffer=out_shm.buf)
+    _side_seg_shared['params'] = (max_mb_dist, mb_ht, orig_pos)
+
+
+def _side_segmentation_worker(z_slices):
+    """
+    Processes a chunk of z-slices and writes the results directly into the shared label volume.
+    """
+    seg = _side_seg_shared['seg']
+    out = _side_seg_shared['out']
+    max_mb_dist, mb_ht, orig_pos = _side_seg_shared['params']
+    for z in z_slices:
+        out[:, :, z] = _get_segmentation_side_for_slice(seg[:, :, z], max_mb_dist, mb_ht, orig_pos)
+    return len(z_slices)
+
+
+def _get_segmentation_side_parallel(pre_seg, max_mb_dist, mb_ht, orig_pos, n_pr):
+    """
+    Distributes the z-slices of the segmentation on a pool of n_pr processes. The segmentation and the output label
+    volume are passed through shared memory, so no volumes are pickled.
+    """
+    seg_shm = shared_memory.SharedMemory(create=True, size=max(pre_seg.nbytes, 1))
+    out_shm = shared_memory.SharedMemory(create=True, size=max(pre_seg.size * np.dtype(np.float64).itemsize, 1))
+    try:
+        seg_shared = np.ndarray(pre_seg.shape, dtype=bool, buffer=seg_shm.buf)
+        seg_shared[:] = pre_seg
+        out_shared = np.ndarray(pre_seg.shape, dtype=np.float64, buffer=out_shm.buf)
+        out_shared[:] = 0.
+
+        # several small chunks per process for load balancing (slices without membrane are cheap)
+        z_chunks = [chunk for chunk in np.array_split(np.arange(pre_seg.shape[2]), n_pr * 4) if chunk.shape[0] > 0]
+        with mp.Pool(n_pr, initializer=_init_side_segmentation_worker,
+                     initargs=(seg_shm.name, out_shm.name, pre_seg.shape, max_mb_dist, mb_ht, orig_pos)) as pool:
+            done_slices = 0
+            for num_slices in pool.imap_unordered(_side_segmentation_worker, z_chunks):
+                done_slices += num_slices
+                print("Processed slices:", done_slices, '/', pre_seg.shape[2])
+        Mbu = np.array(out_shared)
+        del seg_shared, out_shared
+    finally:
+        seg_shm.close()
+        seg_shm.unlink()
+        out_shm.close()
+        out_shm.unlink()
+    return Mbu
+
+
+def _get_segmentation_side_3d(pre_seg, max_mb_dist, mb_ht, orig_pos, return_edt=False):
+    """
+    Segments the surrounding of the membrane on the correct side in a single pass over the whole volume.
+    For each voxel in the surrounding, the connection vector from its closest membrane voxel points along the membrane
+    normal. The voxel is on the correct side if this vector points towards the same side of the membrane as the
+    picked point, i.e. if the dot product with the vector from the membrane voxel to the picked point is positive.
+    pre_seg: cropped binary membrane segmentation
+    max_mb_dist, mb_ht, orig_pos: see _get_segmentation_side
+    return_edt: if True, the distance transform (distances, indices) to the membrane voxels (label 1) is returned as
+    well, or None if it does not coincide with the one computed here (mb_ht > 0)
+    Returns: label volume (1: membrane, 2: correct side)
+    """
+    dist_trafo, mb_idcs = distance_transform_edt(np.logical_not(pre_seg), return_indices=True)
+    Mbu = np.zeros(pre_seg.shape)
+
+    surr_mask = np.logical_and(dist_trafo > mb_ht, dist_trafo <= (max_mb_dist + mb_ht))
+    surr_coords = np.argwhere(surr_mask)
+    closest_mb_coords = mb_idcs[(slice(None),) + tuple(surr_coords.T)].T
+    if not return_edt or mb_ht != 0:
+        mb_idcs = None
+
+    vec_conn_mb = surr_coords - closest_mb_coords
+    vec_mb_orig = orig_pos - closest_mb_coords
+    dots = np.einsum('ij,ij->i', vec_conn_mb, vec_mb_orig)
 
+    Mbu[tuple(surr_coords[dots > 0].T)] = 2
+    Mbu[dist_trafo <= mb_ht] = 1
+    if return_edt:
+        # for mb_ht == 0, the membrane label consists exactly of the segmented voxels
+        return Mbu, ((dist_trafo, mb_idcs) if mb_ht == 0 else None)
+    return Mbu
 
-def _get_segmentation_side(in_seg_path, tomo, max_mb_dist, mb_ht, orig_pos):
+
+def _get_segmentation_bbox(seg, chunk_size=32):
+    """
+    Bounding box (inclusive min and max voxel coordinates) of the nonzero voxels of a (memory-mapped) segmentation.
+    The segmentation is read in z-slabs, so it is never loaded completely.
+    """
+    any_x = np.zeros(seg.shape[0], dtype=bool)
+    any_y = np.zeros(seg.shape[1], dtype=bool)
+    any_z = np.zeros(seg.shape[2], dtype=bool)
+    for z_start in range(0, seg.shape[2], chunk_size):
+        slab = np.asarray(seg[:, :, z_start:z_start + chunk_size]) > 0
+        any_x |= np.any(slab, axis=(1, 2))
+        any_y |= np.any(slab, axis=(0, 2))
+        any_z[z_start:z_start + chunk_size] = np.any(slab, axis=(0, 1))
+    idcs = [np.flatnonzero(any_ax) for any_ax in (any_x, any_y, any_z)]
+    return np.array([idx[0] for idx in idcs]), np.array([idx[-1] for idx in idcs])
+
+
+def _get_segmentation_side(in_seg_path, tomo, max_mb_dist, mb_ht, orig_pos, n_pr=1, use_3d=False, return_edt=False):
     """
     Segments the surrounding of the membrane on the correct side.
     in_seg_path: path to membrane segmentation (binary mrc file)
@@ -195,193 +512,195 @@ def _get_segmentation_side(in_seg_path, tomo, max_mb_dist, mb_ht, orig_pos):
     max_mb_dist: radius of surrounding around membrane to be considered --> also inflences the robustness of picked normals
     mb_ht: thickness of membrane
     orig_pos: reference point specifying the correct side of the membrane.
+    n_pr: number of processes; if larger than 1, z-slices are processed in parallel
+    use_3d: if True, the sides are separated in 3D (see _get_segmentation_side_3d) instead of slice-wise
+    return_edt: if True, additionally returns the distance transform to the membrane if it was computed on the way
+    (3D mode), else None. It can be passed on to sample_uniformly.
     """
-    pre_seg = data_utils.load_tomogram(in_seg_path) > 0
-    seg_coords = np.argwhere(pre_seg)
+    # the segmentation is memory-mapped: only its bounding box is searched slab-wise and the crop is loaded
+    seg = data_utils.load_tomogram_mmap(in_seg_path)
+    seg_min, seg_max = _get_segmentation_bbox(seg)
     add_range = 60
-    rangeX = range(np.maximum(np.min(seg_coords[:, 0]) - add_range, 0), np.minimum(np.max(seg_coords[:, 0]) + add_range,
-                                                                                   pre_seg.shape[0]-1))
-    rangeY = range(np.maximum(np.min(seg_coords[:, 1]) - add_range, 0), np.minimum(np.max(seg_coords[:, 1]) + add_range,
-                                                                                   pre_seg.shape[1]-1))
-    rangeZ = range(np.maximum(np.min(seg_coords[:, 2]) - add_range, 0), np.minimum(np.max(seg_coords[:, 2]) + add_range,
-                                                                                   pre_seg.shape[2]-1))
+    rangeX = range(np.maximum(seg_min[0] - add_range, 0), np.minimum(seg_max[0] + add_range, seg.shape[0]-1))
+    rangeY = range(np.maximum(seg_min[1] - add_range, 0), np.minimum(seg_max[1] + add_range, seg.shape[1]-1))
+    rangeZ = range(np.maximum(seg_min[2] - add_range, 0), np.minimum(seg_max[2] + add_range, seg.shape[2]-1))
     orig_pos -= np.array((rangeX[0], rangeY[0], rangeZ[0]))
 
     ranges = [rangeX, rangeY, rangeZ]
-    pre_seg = pre_seg[rangeX[0]:rangeX[-1], rangeY[0]: rangeY[-1], rangeZ[0]:rangeZ[-1]]
+    pre_seg = np.array(seg[rangeX[0]:rangeX[-1], rangeY[0]: rangeY[-1], rangeZ[0]:rangeZ[-1]]) > 0
+    del seg
     tomo = tomo[rangeX[0]:rangeX[-1], rangeY[0]: rangeY[-1], rangeZ[0]:rangeZ[-1]]
 
-    Mbu = np.zeros(pre_seg.shape)
-
     print("Finding correct segmentation side.")
-    for z in range(pre_seg.shape[2]): # go through the tomogram slice-wise
-        if z % 10 == 0:
-            print("Current slice:", z,'/',  pre_seg.shape[2])
-        if np.sum(pre_seg[:, :, z]) < 5:
-            continue
-        conn_comp_array, tot_conn_comps = label(pre_seg[:, :, z], return_num=True, connectivity=2)
-
-        for conn_comp_nr in range(1, tot_conn_comps + 1):
-            ## Get all points in the surrounding of the membrane segmentation
-            H = np.zeros(pre_seg[:,:,z].shape)
-            dist_trafo, mb_idcs = distance_transform_edt(conn_comp_array != conn_comp_nr, return_indices=True)
-            H_temp = H.copy()
-            H_temp[dist_trafo <= (max_mb_dist + mb_ht)] = 2
-            H_temp[dist_trafo <= mb_ht] = 1
-
-            ## Separate the surrounding using extrapolation of the membrane ends
-            segregation_mask = _extrapolate(H_temp, np.argwhere(conn_comp_array == conn_comp_nr), max_mb_dist)
-            mask = (H_temp == 2) * 1.0
-            mask[segregation_mask == 1] = 2
-            conn_comps_seg, conn_comps_seg_num = label(mask == 1, return_num=True)
-            if conn_comps_seg_num != 2:
-                print("WARNING! The membrane sides are not separated properly! Check whether sampled points are correct.")
-
-            """ Extract indices, their connection vectors to the membranes and the connection vectors to the origin point
-            Compare these two vectors using the dot product
-            Intention: If the dot product is high, the vectors point in the same direction"""
-
-            half1_idcs = np.argwhere(conn_comps_seg == 1)
-            half2_idcs = np.argwhere(conn_comps_seg == 2)
-            surr_coords = np.concatenate((half1_idcs, half2_idcs), axis=0)
-            mb_idcs = np.transpose(mb_idcs, (1, 2, 0))
-
-            vec_conn_mb = surr_coords - mb_idcs[tuple(surr_coords.T)]
-            vec_conn_mb = normalize_vecs(vec_conn_mb)
-
-            vec_conn_cen = surr_coords - orig_pos[:2]
-            vec_conn_cen = normalize_vecs(vec_conn_cen)
-
-            dots = np.einsum('ij,ij->i', vec_conn_cen, vec_conn_mb)
-
-            dots_comp1 = dots[:half1_idcs.shape[0]]
-            dots_comp2 = dots[half1_idcs.shape[0]:]
-            if np.mean(dots_comp1) < np.mean(dots_comp2):
-                idcs_choice = half1_idcs
-            else:
-                idcs_choice = half2_idcs
-            H[tuple(idcs_choice.T)] = 2
-        dist_trafo = distance_transform_edt(pre_seg[:, :, z] == 0)
-        H[dist_trafo <= mb_ht] = 1
-        Mbu[:, :, z] = H
+    edt = None
+    if use_3d:
+        Mbu, edt = _get_segmentation_side_3d(pre_seg, max_mb_dist, mb_ht, orig_pos, return_edt=True)
+    elif n_pr > 1:
+        Mbu = _get_segmentation_side_parallel(pre_seg, max_mb_dist, mb_ht, orig_pos, n_pr)
+    else:
+        Mbu = np.zeros(pre_seg.shape)
+        for z in range(pre_seg.shape[2]): # go through the tomogram slice-wise
+            if z % 10 == 0:
+                print("Current slice:", z,'/',  pre_seg.shape[2])
+            Mbu[:, :, z] = _get_segmentation_side_for_slice(pre_seg[:, :, z], max_mb_dist, mb_ht, orig_pos)
+    if return_edt:
+        return Mbu, tomo, ranges, edt
     return Mbu, tomo, ranges
 
 
-def sample_uniformly(tomo_seg_path, out_path, tomo_token, stack_token, mb_token, shrink_thres, ranges):
+def _membrane_band_edt(tomo_seg, band_width=8., chunk_size=64):
+    """
+    Memory-bounded version of the distance transform used for sampling: Finds all voxels with a distance
+    0.5 < d < band_width to the membrane (label 1), together with their distances and nearest membrane voxels.
+    The volume is cropped to the membrane bounding box (plus band width) and processed in z-chunks with halos of size
+    band_width, so only chunk-sized index volumes (int32) are allocated. Distances are returned as float32.
+
+    tomo_seg: segmentation (membrane labeled as 1)
+    band_width: maximum distance to the membrane
+    chunk_size: number of z-slices processed at once
+    Returns: band voxel coordinates (lexicographically sorted), their distances and their nearest membrane voxels
+    """
+    mb_mask = tomo_seg == 1
+    if not np.any(mb_mask):
+        return np.zeros((0, 3), dtype=np.int32), np.zeros(0, dtype=np.float32), np.zeros((0, 3), dtype=np.int32)
+    halo = int(np.ceil(band_width))
+    crop_start = []
+    crop_end = []
+    for axis in range(3):
+        other_axes = tuple(ax for ax in range(3) if ax != axis)
+        axis_idcs = np.flatnonzero(np.any(mb_mask, axis=other_axes))
+        crop_start.append(max(axis_idcs[0] - halo, 0))
+        crop_end.append(min(axis_idcs[-1] + halo + 1, mb_mask.shape[axis]))
+    no_mb_crop = np.logical_not(mb_mask[crop_start[0]:crop_end[0], crop_start[1]:crop_end[1], crop_start[2]:crop_end[2]])
+    del mb_mask
+    n_z = no_mb_crop.shape[2]
+
+    band_coords, band_dists, band_mb_points = [], [], []
+    for z_start in range(0, n_z, chunk_size):
+        z_end = min(z_start + chunk_size, n_z)
+        halo_start = max(z_start - halo, 0)
+        halo_end = min(z_end + halo, n_z)
+        chunk = no_mb_crop[:, :, halo_start:halo_end]
+        if np.all(chunk):
+            # no membrane voxel within chunk + halo, so no band voxels (and the EDT indices would be undefined)
+            continue
+        idcs = np.empty((3,) + chunk.shape, dtype=np.int32)
+        distance_transform_edt(chunk, return_distances=False, return_indices=True, indices=idcs)
+        idcs = idcs[:, :, :, z_start - halo_start:z_end - halo_start]
+
+        # squared distances are integers, so the band can be selected exactly without a float distance volume
+        sq_dists = np.zeros(idcs.shape[1:], dtype=np.int32)
+        for axis in range(3):
+            grid_shape = [1, 1, 1]
+            grid_shape[axis] = -1
+            grid = np.arange(idcs.shape[axis + 1], dtype=np.int32).reshape(grid_shape)
+            if axis == 2:
+                grid = grid + (z_start - halo_start)
+            sq_dists += (idcs[axis] - grid) ** 2
+        band_mask = np.logical_and(sq_dists > 0, sq_dists < band_width ** 2)
+
+        cur_coords = np.argwhere(band_mask).astype(np.int32)
+        cur_mb_points = np.transpose(idcs[:, band_mask])
+        cur_coords[:, 2] += z_start
+        cur_mb_points[:, 2] += halo_start
+        band_coords.append(cur_coords)
+        band_dists.append(np.sqrt(sq_dists[band_mask]).astype(np.float32))
+        band_mb_points.append(cur_mb_points)
+
+    offset = np.array(crop_start, dtype=np.int32)
+    band_coords = np.concatenate(band_coords, axis=0) + offset
+    band_dists = np.concatenate(band_dists, axis=0)
+    band_mb_points = np.concatenate(band_mb_points, axis=0) + offset
+    order = np.lexsort((band_coords[:, 2], band_coords[:, 1], band_coords[:, 0]))
+    return band_coords[order], band_dists[order], band_mb_points[order]
+
+
+def sample_uniformly(tomo_seg_path, out_path, tomo_token, stack_token, mb_token, shrink_thres, ranges, point_spacing=1.5,
+                     seed=None, low_memory=False, chunk_size=64, tomo_seg=None, edt=None):
     """
     sample points uniformly on previously computed membrane segmentation (with mb sides).
 
     tomo_seg_path: path to segmentation file (should also include picked side, i.e. all points on the correct side
-    should be labeled as '2' in the segmentation
+    should be labeled as '2' in the segmentation; can be None if tomo_seg is given
     out_path: directory to store coordinates
     tomo_token: token of tomogram
     mb_token: token of membrane
     threshold: threshold for cropping the prediction from the edges; should be around 170
+    point_spacing: minimum distance between sampled points (larger values give sparser points)
+    seed: random seed for thinning the sampled points
+    low_memory: if True, the distance transform is computed only around the membrane, in z-chunks and with int32 /
+    float32 outputs, which strongly reduces memory consumption
+    chunk_size: number of z-slices per chunk in low_memory mode
+    tomo_seg: segmentation array; if given, it is used instead of loading tomo_seg_path
+    edt: distance transform (distances, indices) of tomo_seg != 1, if already available (see _get_segmentation_side)
     """
     print('Sampling points.')
-    time_zero = time()
-    tomo_seg = data_utils.load_tomogram(tomo_seg_path)
-    dist_trafo, idcs = distance_transform_edt(tomo_seg != 1, return_indices=True)
-    idcs = np.transpose(idcs, (1,2,3,0))
-    mask = np.logical_and(dist_trafo > 0.5, dist_trafo < 8.)
+    if tomo_seg is None:
+        if tomo_seg_path is None:
+            raise ValueError('Either tomo_seg_path or tomo_seg needs to be specified.')
+        tomo_seg = data_utils.load_tomogram(tomo_seg_path)
+    if low_memory:
+        new_idcs, new_dt, new_mb_points = _membrane_band_edt(tomo_seg, band_width=8., chunk_size=chunk_size)
+        mask10th = np.array(range(new_idcs.shape[0])) % 10 == 0
+        new_idcs, new_dt, new_mb_points = new_idcs[mask10th], new_dt[mask10th], new_mb_points[mask10th]
+        mb_half_mask = tomo_seg[tuple(new_idcs.T)] == 2
+        new_idcs, new_dt, new_mb_points = new_idcs[mb_half_mask], new_dt[mb_half_mask], new_mb_points[mb_half_mask]
+    else:
+        if edt is None:
+            edt = distance_transform_edt(tomo_seg != 1, return_indices=True)
+        dist_trafo, idcs = edt
+        edt = None
+        idcs = np.transpose(idcs, (1,2,3,0))
+        mask = np.logical_and(dist_trafo > 0.5, dist_trafo < 8.)
 
-    new_seg = np.zeros_like(tomo_seg)
-    new_seg[mask] = 1
+        new_seg = np.zeros_like(tomo_seg)
+        new_seg[mask] = 1
 
-    new_idcs = np.argwhere(new_seg == 1)
-    mask10th = np.array(range(new_idcs.shape[0])) % 10 == 0
-    new_idcs = new_idcs[mask10th]
-    mb_half_idcs = np.argwhere(tomo_seg == 2)
+        new_idcs = np.argwhere(new_seg == 1)
+        mask10th = np.array(range(new_idcs.shape[0])) % 10 == 0
+        new_idcs = new_idcs[mask10th]
+        mb_half_idcs = np.argwhere(tomo_seg == 2)
 
-    mb_half_mask = (new_idcs[:, None] == mb_half_idcs).all(-1).any(-1)
-    new_idcs = new_idcs[mb_half_mask]
+        mb_half_mask = _ismember(new_idcs, mb_half_idcs)
+        new_idcs = new_idcs[mb_half_mask]
 
-    new_mb_points = idcs[tuple(new_idcs.T)]
-    new_dt = dist_trafo[tuple(new_idcs.T)]
+        new_mb_points = idcs[tuple(new_idcs.T)]
+        new_dt = dist_trafo[tuple(new_idcs.T)]
 
     conn_vecs = new_idcs - new_mb_points
     unique_mb_points = np.unique(new_mb_points, axis=0)
 
     ## Find edges of membrane
 
-    mb_idcs = np.argwhere(tomo_seg == 1)
-
-    conv_kernel = np.ones((7,7,7))
-    temp_tomo = convolve((tomo_seg == 1)*1.0, conv_kernel)
-    mask = temp_tomo > shrink_thres
-
     print("Shrinking borders of sampled points.")
-    for i in range(2):
-        new_tomo_seg = (tomo_seg == 1) * 1.0
-        new_tomo_seg *= mask
-        temp_tomo = convolve(new_tomo_seg, conv_kernel)
-        mask = temp_tomo > shrink_thres
-
-    new_tomo_seg = (tomo_seg == 1) * 1.0
-    new_tomo_seg *= mask
-    removed_parts = (tomo_seg == 1) - new_tomo_seg
-    removed_idcs = np.argwhere(removed_parts)
+    mb_mask = tomo_seg == 1
+    shrunk_mb_mask = _shrink_membrane_borders(mb_mask, shrink_thres)
+    removed_idcs = np.argwhere(np.logical_and(mb_mask, np.logical_not(shrunk_mb_mask)))
 
-    remove_mask = np.array(1 - (unique_mb_points[:, None] == removed_idcs).all(-1).any(-1))
-    remove_mask = remove_mask == 1
+    remove_mask = np.logical_not(_ismember(unique_mb_points, removed_idcs))
 
     unique_mb_points2 = unique_mb_points[remove_mask]
 
     ## Sample points to decrease density
 
-    points = unique_mb_points2.copy()
-    points = np.concatenate((points, np.expand_dims(np.array(range(points.shape[0])), 1)), 1)
-    remove_mask = np.ones(points.shape[0])
     print("Thinning sampled points.")
-    while points.shape[0] > 1:
-        idx = np.random.randint(points.shape[0])
-        point = points[idx]
-        take_id = point[3]
-        mask = distance_matrix(np.expand_dims(point[:3], 0), points[:, :3]) < 1.5
-        mask = np.squeeze(mask)
-        remove_idcs = points[mask][:, 3]
-        remove_mask[remove_idcs] = 0
-        remove_mask[take_id] = 1
-        points = points[(1 - mask) > 0]
-
-    unique_mb_points2 = unique_mb_points2[remove_mask > 0]
+    keep_mask = _thin_points(unique_mb_points2, min_dist=point_spacing, seed=seed)
+    unique_mb_points2 = unique_mb_points2[keep_mask]
 
     ## Shrink new_mb_points, conn_vecs, new_dt
 
-    mask =  (new_mb_points[:, None] == unique_mb_points2).all(-1).any(-1)
+    mask = _ismember(new_mb_points, unique_mb_points2)
     new_mb_points = new_mb_points[mask]
     conn_vecs = conn_vecs[mask]
     new_dt = new_dt[mask]
 
     ## Compute normals for each point
     print("Computing normals for each point.")
-    points_and_normals = []
-    for i in range(unique_mb_points2.shape[0]):
-        if i % 1000 == 0:
-            point_batch = []
-            coord_batch = []
-        point = unique_mb_points2[i]
-        point_batch.append(point)
-        if i % 1000 == 999 or i == unique_mb_points2.shape[0] - 1:
-            cur_points_and_normals = []
-            point_idcs_list = _find_batch_points(new_mb_points, point_batch)
-
-            for j in range(len(point_idcs_list)):
-                coord = point_batch[j]
-                coord[0] += ranges[0][0]
-                coord[1] += ranges[1][0]
-                coord[2] += ranges[2][0]
-                point_idcs = point_idcs_list[j]
-                vecs = conn_vecs[tuple(point_idcs.T)]
-                dists = new_dt[tuple(point_idcs.T)]
-                max_idcs = np.argwhere(dists == np.amax(dists))
-                longest_vecs = vecs[tuple(max_idcs.T)]
-                avg_longest_vec = np.mean(longest_vecs, axis=-2)
-                cur_points_and_normals.append([coord, avg_longest_vec])
-            points_and_normals += (cur_points_and_normals)
-
-    points = np.array(points_and_normals)[:, 0, :]
-    normals = np.array(points_and_normals)[:, 1, :]
+    if new_mb_points.shape[0] > 0:
+        points, normals = _average_longest_vectors(new_mb_points, conn_vecs, new_dt)
+    else:
+        points, normals = np.zeros((0, 3), dtype=np.int64), np.zeros((0, 3))
+    points = points + np.array([ranges[0][0], ranges[1][0], ranges[2][0]])
     points_and_normals = np.concatenate((points, normals), axis=1)
     out_name = os.path.join(out_path, tomo_token + '_' + stack_token + '_' + mb_token + '_pred_positions.csv')
     data_utils.store_array_in_csv(out_name, points_and_normals)
@@ -392,7 +711,75 @@ def sample_uniformly(tomo_seg_path, out_path, tomo_token, stack_token, mb_token,
 
 
 
-def sample_points_on_seg(out_dir, in_star, out_path, max_mb_dist=60, mh_ht=0, out_bin=4, shrink_thres=118):
+_membrane_shared = {}
+
+
+def _sample_points_for_membrane(tomo, out_dir, out_path, tomo_token, stack_token, mb_token, in_seg_path, orig_pos,
+                                params):
+    """
+    Runs side segmentation and point sampling for a single membrane. The tomogram is only read.
+    Returns the path to the csv file containing the sampled points.
+    """
+    Mbu, tomo, ranges, edt = _get_segmentation_side(in_seg_path, tomo, params['max_mb_dist'], params['mh_ht'],
+                                                    orig_pos, n_pr=params['n_pr'], use_3d=params['use_3d_sides'],
+                                                    return_edt=True)
+
+    mic_out_path = os.path.join(out_dir, 'mics', tomo_token + '_' + stack_token + '_' + mb_token + '.mrc')
+    seg_out_path = os.path.join(out_dir, 'segs', tomo_token + '_' + stack_token + '_' + mb_token + '.mrc')
+    data_utils.store_tomogram(mic_out_path, tomo)
+    if params['store_segs']:
+        data_utils.store_tomogram(seg_out_path, Mbu)
+    # the label volume (and distance transform) are handed over in memory
+    sample_uniformly(None, out_path, tomo_token, stack_token, mb_token, params['shrink_thres'], ranges,
+                     point_spacing=params['point_spacing'], seed=params['seed'], low_memory=params['low_memory'],
+                     tomo_seg=Mbu, edt=(None if params['low_memory'] else edt))
+
+    particle_csv = os.path.join(out_path, tomo_token + '_' + stack_token + '_' + mb_token + '_pred_positions.csv')
+    return particle_csv
+
+
+def _init_membrane_worker(out_dir, out_path, params):
+    _membrane_shared['tomo_path'] = None
+    _membrane_shared['args'] = (out_dir, out_path)
+    _membrane_shared['params'] = params
+
+
+def _membrane_worker(mb_args):
+    """
+    Processes a single membrane (tomo_path, tomo_token, stack_token, mb_token, in_seg_path, orig_pos). The tomogram
+    is memory-mapped (and kept mapped while the worker processes membranes of the same tomogram), so its pages are
+    shared between processes and only the crops around the membranes are read.
+    """
+    tomo_path = mb_args[0]
+    if _membrane_shared['tomo_path'] != tomo_path:
+        _membrane_shared['tomo'] = data_utils.load_tomogram_mmap(tomo_path)
+        _membrane_shared['tomo_path'] = tomo_path
+    out_dir, out_path = _membrane_shared['args']
+    return _sample_points_for_membrane(_membrane_shared['tomo'], out_dir, out_path, *mb_args[1:],
+                                       params=_membrane_shared['params'])
+
+
+def _sample_points_parallel(out_dir, out_path, mb_args_list, params, n_pr_mbs):
+    """
+    Distributes all membranes (of all tomograms) on a pool of processes.
+    """
+    with mp.Pool(min(n_pr_mbs, len(mb_args_list)), initializer=_init_membrane_worker,
+                 initargs=(out_dir, out_path, params)) as pool:
+        particle_csvs = pool.map(_membrane_worker, mb_args_list, chunksize=1)
+    return particle_csvs
+
+
+def sample_points_on_seg(out_dir, in_star, out_path, max_mb_dist=60, mh_ht=0, out_bin=4, shrink_thres=118,
+                         point_spacing=1.5, seed=None, n_pr=1, use_3d_sides=False, low_memory=False, n_pr_mbs=1,
+                         store_segs=True):
+    """
+    Samples points and normals on all membranes listed in the star file. Tomograms are memory-mapped, so only the crops
+    around the membranes are read.
+    n_pr: number of processes for the side segmentation of each membrane
+    n_pr_mbs: number of processes for sampling; if larger than 1, all membranes (also of different tomograms) are
+    processed in parallel
+    store_segs: if True, the side segmentations are stored in out_dir/segs (needed for inspecting the picked sides)
+    """
     star_dict = star_utils.read_star_file_as_dict(in_star)
     tomo_tokens = star_dict['tomoToken']
     tomo_paths = star_dict['tomoPath']
@@ -404,31 +791,22 @@ def sample_points_on_seg(out_dir, in_star, out_path, max_mb_dist=60, mh_ht=0, ou
     orig_posZ = star_dict['origin_pos_z']
 
     out_star = os.path.join(out_path, os.path.basename(in_star))
-    prev_tomo_token = ''
-    particle_csvs = []
-    for i, tomo_token in enumerate(tomo_tokens):
-        tomo_path = tomo_paths[i]
-        mb_token = mb_tokens[i]
-        # if mb_token == 'M2':
-        #     continue
-        stack_token = stack_tokens[i]
-        # tomo_bin = tomo_bins[i]
-        in_seg_path = seg_paths[i]
-        orig_pos = np.array((orig_posX[i], orig_posY[i], orig_posZ[i]), dtype=np.float)
-        # gt_path = gt_paths[i]
-
-        if prev_tomo_token != tomo_token:
-            tomo = data_utils.load_tomogram(tomo_path)
-            Mbu, tomo, ranges = _get_segmentation_side(in_seg_path, tomo, max_mb_dist, mh_ht, orig_pos)
+    params = {'max_mb_dist': max_mb_dist, 'mh_ht': mh_ht, 'shrink_thres': shrink_thres, 'point_spacing': point_spacing,
+              'seed': seed, 'n_pr': n_pr, 'use_3d_sides': use_3d_sides, 'low_memory': low_memory,
+              'store_segs': store_segs}
 
-            mic_out_path = os.path.join(out_dir, 'mics', tomo_token + '_' + stack_token + '_' + mb_token + '.mrc')
-            seg_out_path = os.path.join(out_dir, 'segs', tomo_token + '_' + stack_token + '_' + mb_token + '.mrc')
-            data_utils.store_tomogram(mic_out_path, tomo)
-            data_utils.store_tomogram(seg_out_path, Mbu)
-            sample_uniformly(seg_out_path, out_path, tomo_token, stack_token, mb_token, shrink_thres, ranges)
+    mb_args_list = []
+    for i, tomo_path in enumerate(tomo_paths):
+        orig_pos = np.array((orig_posX[i], orig_posY[i], orig_posZ[i]), dtype=np.float)
+        mb_args_list.append((tomo_path, tomo_tokens[i], stack_tokens[i], mb_tokens[i], seg_paths[i], orig_pos))
 
-            particle_csv = os.path.join(out_path, tomo_token + '_' + stack_token + '_' + mb_token + '_pred_positions.csv')
-            particle_csvs.append(particle_csv)
+    if n_pr_mbs > 1 and len(mb_args_list) > 1:
+        # pool workers are daemonic and cannot start their own processes for side segmentation
+        particle_csvs = _sample_points_parallel(out_dir, out_path, mb_args_list, dict(params, n_pr=1), n_pr_mbs)
+    else:
+        _init_membrane_worker(out_dir, out_path, params)
+        particle_csvs = [_membrane_worker(mb_args) for mb_args in mb_args_list]
+        _membrane_shared.clear()
 
     star_dict_out = star_dict.copy()
     star_dict_out['particleCSV'] = particle_csvs
@@ -22,7 +22,11 @@ def main():
                                               unbinned_offset_Z=UNBINNED_OFFSET_Z)
     inspect_segmentations.fuse_segmentations_together(out_star, os.path.join(project_directory, 'temp_files/'))
     inspect_segmentations.inspect_segmentation_before(out_star, out_star2, os.path.join(project_directory, 'temp_files/'))
-    normals_star = sample_points_on_seg(project_directory, out_star2, os.path.join(project_directory, 'positions', 'sampled'), max_mb_dist=MAX_DIST_FROM_MEMBRANE)
+    normals_star = sample_points_on_seg(project_directory, out_star2, os.path.join(project_directory, 'positions', 'sampled'),
+                                        max_mb_dist=MAX_DIST_FROM_MEMBRANE, point_spacing=POINT_SPACING,
+                                        n_pr=N_PR_SIDE_SEGMENTATION, use_3d_sides=USE_3D_SIDE_SEGMENTATION,
+                                        low_memory=LOW_MEMORY_SAMPLING, n_pr_mbs=N_PR_SAMPLING,
+                                        store_segs=STORE_SIDE_SEGMENTATIONS)
     normals_corrected_star = normal_voting_for_star(normals_star, os.path.join(project_directory, 'positions', 'normals_corrected'), npr=N_PR_NORMALVOTING)
     compute_all_Euler_angles_for_star(normals_corrected_star, os.path.join(project_directory, 'positions', 'normals_corrected_with_euler'))
 
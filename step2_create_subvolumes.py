@@ -12,15 +12,20 @@ def main():
     out_star_name = os.path.join(os.path.join(project_directory, 'positions', 'normals_corrected_with_euler'),
                                  PROJECT_NAME + '_with_inner_outer.star')
     settings = ParameterSettings(out_star_name)#
+    cache_dir = os.path.join(project_directory, 'temp_files', 'preprocessed_tomos') if CACHE_PREPROCESSED_TOMOS else None
     rotator = Rotator(os.path.join(project_directory, 'rotated_volumes'), out_bins=[4], pred_bin=4,
                                        box_range=BOX_RANGE, settings=settings, n_pr=N_PR_ROTATION,
                                        store_dir=os.path.join(project_directory, 'rotated_volumes', 'raw'),
-                                       store_normals=True, store_angles=True, preprocess_tomograms=True, lp_cutoff=LP_CUTOFF)
+                                       store_normals=True, store_angles=True, preprocess_tomograms=True, lp_cutoff=LP_CUTOFF,
+                                       tomo_spline_coeffs=TOMO_SPLINE_COEFFICIENTS, fft_workers=N_PR_FFT,
+                                       cache_dir=cache_dir, compression=SUBVOLUME_COMPRESSION,
+                                       storage_dtype=SUBVOLUME_STORAGE_DTYPE)
     out_star_name = rotator.rotate_all_volumes()
     out_star_name = os.path.join(os.path.join(project_directory, 'rotated_volumes'), os.path.basename(out_star_name))
 
     add_labels_and_distances(out_star_name, project_directory, prot_tokens=PROT_TOKENS, prot_shapes=PROT_SHAPES,
-                             particle_orientations=True, membranorama_xmls=True)
+                             particle_orientations=True, membranorama_xmls=True,
+                             compression=SUBVOLUME_COMPRESSION)
     add_datasplit_to_star(out_star_name, val_tokens=VAL_TOKENS, train_tokens=TRAIN_TOKENS, test_tokens=TEST_TOKENS)
 
 
@@ -646,17 +646,45 @@ class Affine(object):
 
         return res
 
+    # cache of index grids and coordinate buffers used in transformArray(),
+    # keyed by (shape, dtype). Typically only a few shapes are transformed
+    # (one per subvolume size), so a small cache suffices; it is cleared
+    # when full to keep the memory for grids of stray shapes bounded (16
+    # float64 grids and buffers for 25^3 subvolumes take about 12 MB)
+    _grid_cache = {}
+    _grid_cache_size = 16
+
+    @classmethod
+    def _getCachedGrid(cls, shape, dtype):
+        """
+        Returns the index grid for an array of the given shape (flattened
+        to n_dim x n_points) and a buffer of the same shape for the
+        transformed grid. Both are cached, so that transforming many arrays
+        of the same shape does not reallocate the grids.
+        """
+        key = (tuple(shape), numpy.dtype(dtype).str)
+        if key not in cls._grid_cache:
+            if len(cls._grid_cache) >= cls._grid_cache_size:
+                cls._grid_cache.clear()
+            grid = numpy.mgrid[tuple([slice(0, sha) for sha in shape])]
+            grid = grid.reshape(len(shape), -1).astype(dtype)
+            cls._grid_cache[key] = (grid, numpy.empty_like(grid))
+        return cls._grid_cache[key]
+
     def transformArray(
             self, array, origin, return_grid=False, output=None,
-            order=1, mode='constant', cval=0.0, prefilter=False):
+            order=1, mode='constant', cval=0.0, prefilter=False,
+            grid_dtype=numpy.float32):
         """
         Transformes the given array, typically an image (arg array)
         according to the transformation of this instance. Rotation
         center is given by arg origin.
 
-        Uses transform() method to (inversly) transform the complete index
+        Uses the (inverse) transformation to transform the complete index
         (coordinate) grid corresponding to the given array to make the
-        transformed grid.
+        transformed grid. The index grid and the buffer for the transformed
+        grid are cached by (shape, grid_dtype), so repeated calls for arrays
+        of the same shape do not allocate new grids.
 
         Then it calls scipy.ndimage.map_coordinates() to transform the
         image according to the transformed grid. This step includes
@@ -679,16 +707,36 @@ class Affine(object):
           for splines), default False
           - mode: how to deal with points outside boundaries, default 'constant'
           - cval: outside value for mode 'constant'
+          - grid_dtype: dtype of the coordinate grids, default float32.
+          numpy.float64 gives exactly the same grid as transform() with
+          xy_axes='mgrid'. With float32, coordinates differ by rounding
+          errors (about 1e-5), which also changes voxels whose coordinates
+          lie exactly on the array boundary in mode 'constant' (e.g. for
+          rotations by multiples of 90 degrees)
 
         Returns:
           - transformed array (image)
           - (optional) grid used for the transformation
         """
 
-        # inverse transform original grid
+        # inverse transform original grid, same operations as
+        # inverse.transform(grid, origin=origin, xy_axes='mgrid'):
+        #   new_grid = gl_inv grid + d_inv + (1 - gl_inv) origin
+        # gl_inv and the total translation are obtained (exactly) by
+        # transforming the unit vectors without translation and the zero
+        # point, so that subclasses use their own transform parameters
         inverse = self.inverse()
-        ori_grid = numpy.mgrid[tuple([slice(0, sha) for sha in array.shape])]
-        new_grid = inverse.transform(ori_grid, origin=origin, xy_axes='mgrid')
+        ndim = len(array.shape)
+        grid, new_grid = self._getCachedGrid(array.shape, grid_dtype)
+        gl = inverse.transform(
+            x=numpy.identity(ndim), d=0, xy_axes='dim_point')
+        d = inverse.transform(
+            x=numpy.zeros((ndim, 1)), origin=origin, xy_axes='dim_point')
+        numpy.dot(numpy.asarray(gl, dtype=grid_dtype), grid, out=new_grid)
+        new_grid += numpy.asarray(d, dtype=grid_dtype)
+        new_grid = new_grid.reshape((ndim,) + tuple(array.shape))
+        if return_grid:
+            new_grid = new_grid.copy()
 
         # transform image
         new_image = scipy.ndimage.map_coordinates(
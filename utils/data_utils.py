@@ -311,6 +311,82 @@ def store_pred_results_in_h5(data_dict, out_dir, star_file=None):
     return out_star_file
 
 
+def get_h5_compression_kwargs(compression=None):
+    """
+    Keyword arguments for h5py's create_dataset for the given compression (None, 'gzip', 'lzf' or 'lz4').
+    'lz4' needs the hdf5plugin package.
+    """
+    if compression is None:
+        return {}
+    if compression == 'lz4':
+        import hdf5plugin
+        return dict(hdf5plugin.LZ4())
+    return {'compression': compression}
+
+
+def quantize_subvolumes(volumes, storage_dtype):
+    """
+    Converts subvolumes to the storage dtype.
+    Float dtypes (e.g. float16) are stored as they are. For unsigned integer dtypes (uint8, uint16), the value range of
+    each subvolume is mapped to the full range of the dtype, so nothing is clipped and the precision adapts to the
+    contrast of each subvolume.
+    Returns the converted subvolumes and per-subvolume scales and offsets (see dequantize_subvolumes).
+    """
+    storage_dtype = np.dtype(storage_dtype)
+    volumes = np.asarray(volumes)
+    n = volumes.shape[0]
+    if storage_dtype.kind == 'f':
+        return volumes.astype(storage_dtype), np.ones(n, dtype=np.float32), np.zeros(n, dtype=np.float32)
+    axes = tuple(range(1, volumes.ndim))
+    offsets = np.amin(volumes, axis=axes).astype(np.float32)
+    scales = (np.amax(volumes, axis=axes) - offsets).astype(np.float32) / np.iinfo(storage_dtype).max
+    scales[scales == 0] = 1.
+    expand = (-1,) + (1,) * (volumes.ndim - 1)
+    volumes = (volumes.astype(np.float32) - offsets.reshape(expand)) / scales.reshape(expand)
+    np.rint(volumes, out=volumes)
+    np.clip(volumes, 0, np.iinfo(storage_dtype).max, out=volumes)
+    return volumes.astype(storage_dtype), scales, offsets
+
+
+def dequantize_subvolumes(volumes, scale=1., offset=0.):
+    """
+    Inverse of quantize_subvolumes: volumes * scale + offset. Scale and offset can be scalars (e.g. for a single
+    subvolume) or arrays with one entry per subvolume.
+    Returns float32 (float64 data stored as float64 is kept as it is if scale is 1 and offset is 0).
+    """
+    volumes = np.asarray(volumes)
+    if volumes.dtype.kind == 'f' and np.all(np.asarray(scale) == 1.) and np.all(np.asarray(offset) == 0.):
+        return volumes if volumes.dtype.itemsize >= 4 else volumes.astype(np.float32)
+    scale = np.asarray(scale, dtype=np.float32)
+    offset = np.asarray(offset, dtype=np.float32)
+    if scale.ndim == 1:
+        scale = scale.reshape((-1,) + (1,) * (volumes.ndim - 1))
+        offset = offset.reshape((-1,) + (1,) * (volumes.ndim - 1))
+    out = volumes.astype(np.float32)
+    out *= scale
+    out += offset
+    return out
+
+
+def read_subvolumes(mb_group, dequantize=True):
+    """
+    Reads the subvolumes of a membrane group of an .h5 file.
+    If dequantize is True, the stored values are converted back to float values. Otherwise, the stored (compact) array
+    is returned together with the per-subvolume scales and offsets ('subvolume_scales' / 'subvolume_offsets' datasets,
+    only present for quantized storage).
+    """
+    subvolumes = np.array(mb_group.get('subvolumes'))
+    n = subvolumes.shape[0]
+    if 'subvolume_scales' in mb_group:
+        scales = np.array(mb_group.get('subvolume_scales'), dtype=np.float32)
+        offsets = np.array(mb_group.get('subvolume_offsets'), dtype=np.float32)
+    else:
+        scales, offsets = np.ones(n, dtype=np.float32), np.zeros(n, dtype=np.float32)
+    if dequantize:
+        return dequantize_subvolumes(subvolumes, scales, offsets)
+    return subvolumes, scales, offsets
+
+
 def convert_csv_to_vtp(in_path, out_path, delimiter=',', hasHeader=False):
     """
     Converts a .csv file to a vtp file containing the points and their respective normal vectors.
@@ -391,25 +467,37 @@ def convert_csv_to_vtp(in_path, out_path, delimiter=',', hasHeader=False):
         print(error_msg)
 
 
+def get_valid_box_mask(centers, lower, upper, tomo_shape):
+    """
+    Vectorized range check for boxes around integer centers (N x 3): a box is valid if center - lower >= 0 and
+    center + upper < tomo_shape along all axes.
+    """
+    centers = np.asarray(centers).reshape(-1, 3)
+    return np.all((centers - lower >= 0) & (centers + upper < np.array(tomo_shape[:3])), axis=1)
+
+
+def extract_subvolumes(tomo, centers, lower, box_size, batch_size=1024):
+    """
+    Extracts cubes of size box_size^3 starting at center - lower for all integer centers (N x 3) at once.
+    The cubes are gathered from a sliding window view of the tomogram into a single preallocated array, so the
+    boxes need to be inside the tomogram (see get_valid_box_mask).
+    """
+    centers = np.asarray(centers, dtype=np.int64).reshape(-1, 3)
+    starts = centers - lower
+    windows = np.lib.stride_tricks.sliding_window_view(tomo, (box_size,) * 3)
+    subvols = np.empty((centers.shape[0],) + (box_size,) * 3, dtype=tomo.dtype)
+    for start in range(0, centers.shape[0], batch_size):
+        cur_starts = starts[start:start + batch_size]
+        subvols[start:start + batch_size] = windows[cur_starts[:, 0], cur_starts[:, 1], cur_starts[:, 2]]
+    return subvols
+
+
 def get_subtomos_from_coords(tomo, coords, box_range, normals=None, return_normals=True):
-    add_component = box_range
-    subvol_list = []
-    for i in range(coords.shape[0]):
-        positions = coords[i, :]
-        continue_flag = False
-        for j in range(3):
-            if int(round(positions[j]) - add_component) < 0 or int(round(positions[j]) + add_component) + 1 >= \
-                    tomo.shape[j]:
-                continue_flag = True
-        if continue_flag:
-            continue
-        cur_subvol = tomo[int(round(positions[0]) - add_component): int(round(positions[0]) + add_component),
-                 int(round(positions[1]) - add_component): int(round(positions[1]) + add_component),
-                 int(round(positions[2]) - add_component): int(round(positions[2]) + add_component)]
-        subvol_list.append(cur_subvol)
-    if len(subvol_list) == 0:
+    centers = np.round(np.array(coords, dtype=np.float)[:, :3]).astype(np.int64)
+    valid = get_valid_box_mask(centers, box_range, box_range + 1, tomo.shape)
+    if not np.any(valid):
         return None, None, None
-    subvols = np.stack(subvol_list)
+    subvols = extract_subvolumes(tomo, centers[valid], box_range, 2 * box_range)
     return subvols, coords, normals
 
 
@@ -870,6 +958,32 @@ def load_tomogram(filename, return_header=False):
     return data
 
 
+def load_tomogram_mmap(filename):
+    """
+    Memory-maps a tomogram and returns a lazy, read-only view in the form x,y,z (like load_tomogram).
+    No data is read until the view is indexed, so crops and single slices only read the parts of the file they need.
+    Use np.array() on a crop to load it into memory.
+    :param filename:
+    :return:
+    """
+    print("Memory-mapping tomogram:", filename)
+    with mrcfile.mmap(filename, mode='r', permissive=True) as mrc:
+        data = mrc.data
+    # the memmap stays valid after closing the file
+    return np.transpose(data, (2,1,0))
+
+
+def load_tomogram_crop(filename, ranges):
+    """
+    Loads only a crop of a tomogram (in the form x,y,z) into memory.
+    :param filename:
+    :param ranges: list of three (start, stop) tuples or slices for the x, y and z axes
+    :return:
+    """
+    crop = tuple(rng if isinstance(rng, slice) else slice(rng[0], rng[1]) for rng in ranges)
+    return np.array(load_tomogram_mmap(filename)[crop])
+
+
 def store_tomogram(filename, tomogram, header_dict=None):
     if tomogram.dtype != np.int8:
         tomogram = np.array(tomogram, dtype=np.float32)
@@ -1094,6 +1208,18 @@ def convert_euler(angles, init, final):
     return result
 
 
+def convert_euler_batch(angles, init, final):
+    """
+    Vectorized version of convert_euler for multiple sets of Euler angles.
+    angles: (N, 3) array where each row is (phi, theta, psi)
+    init, final: Euler angle conventions (see convert_euler)
+    Returns: (N, 3) array of converted Euler angles
+    """
+    angles = np.asarray(angles, dtype=float).reshape(-1, 3)
+    result = convert_euler(angles=angles.T, init=init, final=final)
+    return np.stack([np.broadcast_to(ang, angles.shape[:1]) for ang in result], axis=1)
+
+
 def get_stack_from_file_name(file_name, settings):
     assert isinstance(settings, ParameterSettings)
     tomo_tokens = settings.tomo_tokens
@@ -81,7 +81,7 @@ def inspect_segmentation_before(star_file, out_star_file, temp_folder):
     mem_count = 0
     for i, tomo_token in enumerate(tomo_tokens):
         if tomo_token != prev_token:
-            tomo = data_utils.load_tomogram(tomo_paths[i])
+            tomo = data_utils.load_tomogram_mmap(tomo_paths[i])  # only single slices are needed
             all_seg = data_utils.load_tomogram(os.path.join(temp_folder, tomo_token + '_all_mbs.mrc'))
             prev_token = tomo_token
 
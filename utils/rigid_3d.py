@@ -1207,6 +1207,23 @@ class Rigid3D(Affine):
               np.cos(theta)]])
         return r
 
+    @classmethod
+    def make_r_euler_batch(cls, angles, mode='zxz_ex_active'):
+        """
+        Returns 3D rotation matrices for multiple sets of Euler angles at
+        once. Same as make_r_euler(), but all angles are processed in a
+        vectorized way.
+
+        Arguments:
+          - angles: (N, 3) array where each row is [phi, theta, psi] in rad
+          - mode: Euler angles convention, see make_r_euler()
+
+        Returns (ndarray) rotation matrices of shape (N, 3, 3)
+        """
+        angles = np.asarray(angles, dtype=float).reshape(-1, 3)
+        r = cls.make_r_euler(angles=angles.T, mode=mode)
+        return np.moveaxis(np.asarray(r, dtype=float).reshape(3, 3, -1), -1, 0)
+
     @classmethod
     def convert_euler(cls, angles, init, final):
         """
@@ -1318,6 +1335,27 @@ class Rigid3D(Affine):
 
         return result
 
+    @classmethod
+    def convert_euler_batch(cls, angles, init, final):
+        """
+        Converts multiple sets of Euler angles from the initial to the final
+        Euler angle convention (mode) at once. Same as convert_euler(), but
+        vectorized.
+
+        Arguments:
+          - angles: (N, 3) array where each row is (phi, theta, psi)
+          - init: Euler angles convention (mode) in which arg. angles are
+          specified
+          - final: Euler angles convention (mode) to which arg. angles
+          should be converted
+
+        Returns (N, 3) array of Euler angles in the final convention (mode).
+        """
+        angles = np.asarray(angles, dtype=float).reshape(-1, 3)
+        result = cls.convert_euler(angles=angles.T, init=init, final=final)
+        return np.stack(
+            [np.broadcast_to(ang, angles.shape[:1]) for ang in result], axis=1)
+
     @classmethod
     def make_r_axis(cls, angle, axis):
         """
@@ -1465,6 +1503,56 @@ class Rigid3D(Affine):
                 return np.array([[phi_1_ret, theta_1, psi_1_ret],
                                  [phi_2_ret, theta_2, psi_2_ret]])
 
+    @classmethod
+    def extract_euler_batch(cls, r, mode='zxz_ex_active'):
+        """
+        Calculates Euler angles from multiple rotation matrices at once.
+        Same as extract_euler() with ret='one' (the solution with positive
+        theta), but vectorized.
+
+        Arguments:
+          - r: rotation matrices of shape (N, 3, 3)
+          - mode: Euler angles convention, currently implemented
+          'zxz_ex_active', 'zxz_in_active', 'zyz_ex_active' and
+          'zyz_in_active'
+
+        Returns (N, 3) array where each row is [phi, theta, psi]
+        """
+
+        # calculate first for active xzx extrinsic
+        r = np.asarray(r, dtype=float).reshape(-1, 3, 3)
+        theta = np.arccos(r[:, 2, 2])
+        degenerate = theta == 0
+
+        # non degenerate
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sin_theta = np.sin(theta)
+            psi = np.arctan2(r[:, 0, 2] / sin_theta, -r[:, 1, 2] / sin_theta)
+            phi = np.arctan2(r[:, 2, 0] / sin_theta, r[:, 2, 1] / sin_theta)
+
+        # degenerate case
+        psi = np.where(degenerate, 0., psi)
+        phi = np.where(degenerate, np.arctan2(-r[:, 0, 1], r[:, 0, 0]), phi)
+
+        if (mode == 'x') or (mode == 'zxz_ex_active'):
+            result = [phi, theta, psi]
+        elif (mode == 'zxz_in_active'):
+            result = [psi, theta, phi]
+        elif (mode == 'zyz_ex_active'):
+            result = [cls.shift_angle_range(angle=phi + np.pi/2, low=-np.pi),
+                      theta,
+                      cls.shift_angle_range(angle=psi - np.pi/2, low=-np.pi)]
+        elif (mode == 'zyz_in_active'):
+            result = [cls.shift_angle_range(angle=psi - np.pi/2, low=-np.pi),
+                      theta,
+                      cls.shift_angle_range(angle=phi + np.pi/2, low=-np.pi)]
+        else:
+            raise ValueError(
+                "Mode " + mode + " is not defined. Currently implemented "
+                + "are 'zxz_ex_active' (same as 'x'), 'zxz_in_active', "
+                + "'zyz_ex_active' and 'zyz_in_active'.")
+        return np.stack(result, axis=1)
+
     @classmethod
     def shift_angle_range(cls, angle, low=-np.pi):
         """